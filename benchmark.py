@@ -0,0 +1,227 @@
+"""Offline throughput benchmark for session_bot.
+
+Drives link_processor/process_video_url and the broadcast engine against local stand-ins:
+a fake pyrogram client (configurable latency + FloodWait injection), mongomock (or a local
+mongod via BENCH_MONGO_URI), and a local HTTP server whose files yt-dlp's generic extractor
+downloads. Nothing touches the network.
+
+    python benchmark.py --jobs 40 --media-mb 4 --repeat --broadcast-users 2000
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+from types import SimpleNamespace
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--jobs", type=int, default=20, help="links to submit")
+    p.add_argument("--users", type=int, default=0, help="distinct users sending them (default: one per job)")
+    p.add_argument("--workers", type=int, default=3, help="MAX_CONCURRENT_DOWNLOADS")
+    p.add_argument("--media-mb", type=float, default=2, help="size of each served test file")
+    p.add_argument("--api-latency", type=float, default=0.05, help="seconds per fake Telegram API call")
+    p.add_argument("--upload-mbps", type=float, default=50, help="fake upload bandwidth in MB/s")
+    p.add_argument("--floodwait-rate", type=float, default=0.0, help="probability a fake API call raises FloodWait")
+    p.add_argument("--floodwait-seconds", type=int, default=1)
+    p.add_argument("--floodwait-calls", default="copy_message,edit_text", help="comma-separated fake API calls that may raise FloodWait")
+    p.add_argument("--repeat", action="store_true", help="send every link a second time to measure the cached path")
+    p.add_argument("--broadcast-users", type=int, default=0, help="also benchmark a broadcast to this many users")
+    return p.parse_args()
+
+# --- Local media host ---
+class MediaHandler(BaseHTTPRequestHandler):
+    payload = b""
+    def _headers(self):
+        self.send_response(200); self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(len(self.payload))); self.end_headers()
+    def do_HEAD(self): self._headers()
+    def do_GET(self): self._headers(); self.wfile.write(self.payload)
+    def log_message(self, *args): pass
+
+def start_media_server(size_bytes):
+    MediaHandler.payload = os.urandom(int(size_bytes))
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f"http://127.0.0.1:{httpd.server_address[1]}"
+
+# --- Fake Telegram ---
+class FakeTelegram:
+    """Records every API call and simulates latency, upload bandwidth and FloodWaits."""
+    def __init__(self, latency, upload_mbps, floodwait_rate, floodwait_seconds, floodwait_calls):
+        self.latency = latency; self.upload_bps = upload_mbps * 1024 * 1024
+        self.floodwait_rate = floodwait_rate; self.floodwait_seconds = floodwait_seconds; self.floodwait_calls = set(floodwait_calls)
+        self.calls = {}; self.floodwaits = 0; self.uploaded_bytes = 0; self._ids = 0; self.messages = {}
+
+    def next_id(self): self._ids += 1; return self._ids
+
+    async def call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+        if name in self.floodwait_calls and self.floodwait_rate and random.random() < self.floodwait_rate:
+            from pyrogram.errors import FloodWait
+            self.floodwaits += 1; raise FloodWait(value=self.floodwait_seconds)
+
+# Texts that end a job from the user's point of view: (prefix, counts as success)
+FINAL_TEXTS = (("✅ **Upload complete", True), ("❌", False), ("✅ **Operation cancelled", False), ("🤚", False), ("Please send a valid link", False))
+
+class FakeMessage:
+    def __init__(self, tg, chat_id, text="", user_id=None, origin=None):
+        self.tg = tg; self.id = tg.next_id(); tg.messages[self.id] = self; self.chat = SimpleNamespace(id=chat_id); self.text = text
+        self.from_user = SimpleNamespace(id=user_id or chat_id, mention=f"user{chat_id}", first_name="Bench", last_name=None, username=None)
+        self.origin = origin; self.video = None; self.document = None
+        self.submitted = time.perf_counter(); self.done = asyncio.get_running_loop().create_future()
+
+    def finish(self, ok):
+        if not self.done.done(): self.done.set_result((time.perf_counter(), ok))
+
+    def _finish_origin(self, text):
+        if self.origin is None: return
+        for prefix, ok in FINAL_TEXTS:
+            if text.startswith(prefix): self.origin.finish(ok); return
+
+    async def reply_text(self, text, quote=False, reply_markup=None):
+        await self.tg.call("reply_text"); reply = FakeMessage(self.tg, self.chat.id, text, origin=self)
+        reply._finish_origin(text); return reply
+
+    async def edit_text(self, text, reply_markup=None):
+        try: await self.tg.call("edit_text"); self.text = text
+        finally: self._finish_origin(text)  # an injected FloodWait must not leave the job looking unfinished
+
+    async def delete(self): await self.tg.call("delete")
+    async def forward(self, chat_id): await self.tg.call("forward")
+
+class FakeClient:
+    def __init__(self, tg): self.tg = tg
+    async def get_chat_member(self, chat_id, user_id):
+        from pyrogram.enums import ChatMemberStatus
+        await self.tg.call("get_chat_member"); return SimpleNamespace(status=ChatMemberStatus.MEMBER)
+    async def send_video(self, chat_id, video, caption=None, thumb=None, supports_streaming=True, progress=None, progress_args=(), reply_to_message_id=None):
+        await self.tg.call("send_video")
+        msg = FakeMessage(self.tg, chat_id)
+        if os.path.exists(str(video)):
+            total = os.path.getsize(video); step = max(total // 5, 1)
+            for sent in range(step, total + step, step):
+                await asyncio.sleep(step / self.tg.upload_bps)
+                if progress: await progress(min(sent, total), total, *progress_args)
+            self.tg.uploaded_bytes += total
+            msg.video = SimpleNamespace(file_id=f"file-{msg.id}")
+        else: msg.video = SimpleNamespace(file_id=video)  # re-sent from a cached file_id
+        if reply_to_message_id in self.tg.messages: self.tg.messages[reply_to_message_id].finish(True)  # answered without a status message
+        return msg
+    async def copy_message(self, chat_id, from_chat_id, message_id): await self.tg.call("copy_message")
+    async def edit_message_text(self, chat_id, message_id, text): await self.tg.call("edit_message_text")
+    async def send_message(self, chat_id, text): await self.tg.call("send_message")
+
+# --- Measurement helpers ---
+class LoopBlockMonitor:
+    """Measures how long the event loop was unable to run a 10ms ticker."""
+    def __init__(self, interval=0.01, threshold=0.005):
+        self.interval = interval; self.threshold = threshold; self.blocked = 0.0; self.worst = 0.0; self._task = None
+    async def _run(self):
+        while True:
+            start = time.perf_counter(); await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            if lag > self.threshold: self.blocked += lag
+            self.worst = max(self.worst, lag)
+    def start(self): self._task = asyncio.create_task(self._run())
+    def stop(self): self._task.cancel()
+
+class DbErrorCounter:
+    """Wraps session_bot.db_call so DB failures, which the bot only prints, end up in the report."""
+    def __init__(self, db_call): self.db_call = db_call; self.errors = Counter()
+    async def __call__(self, fn, *args, **kwargs):
+        try: return await self.db_call(fn, *args, **kwargs)
+        except Exception as e: self.errors[f"{getattr(fn, '__name__', 'db call')}: {type(e).__name__}: {e}"] += 1; raise
+
+def percentile(values, pct):
+    if not values: return float("nan")
+    values = sorted(values); return values[min(int(round(pct / 100 * (len(values) - 1))), len(values) - 1)]
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def report(title, results, elapsed, monitor, tg):
+    latencies = [r[0] for r in results]; ok = sum(1 for r in results if r[1])
+    print(f"\n== {title} ==")
+    print(f"jobs: {len(results)} ({ok} ok)   elapsed: {elapsed:.2f}s   throughput: {len(results) / elapsed:.2f} jobs/s")
+    print(f"latency p50: {percentile(latencies, 50):.3f}s   p99: {percentile(latencies, 99):.3f}s")
+    print(f"event loop blocked: {monitor.blocked:.3f}s total, worst stall {monitor.worst * 1000:.1f}ms")
+    print(f"telegram calls: {dict(sorted(tg.calls.items()))}   floodwaits injected: {tg.floodwaits}")
+
+# --- Scenarios ---
+async def run_links(bot, tg, client, urls, users):
+    monitor = LoopBlockMonitor(); monitor.start(); start = time.perf_counter()
+    messages = [FakeMessage(tg, 1_000_000 + i % users, url) for i, url in enumerate(urls)]
+    await asyncio.gather(*(bot.link_processor(client, m) for m in messages))
+    done = await asyncio.gather(*(m.done for m in messages))
+    elapsed = time.perf_counter() - start; monitor.stop()
+    return [(t - m.submitted, ok) for m, (t, ok) in zip(messages, done)], elapsed, monitor
+
+async def run_broadcast(bot, tg, count):
+    bot.users_collection.insert_many([{"_id": 5_000_000 + i} for i in range(count)])
+    owner_msg = FakeMessage(tg, bot.OWNER_ID, "hello"); status = await owner_msg.reply_text("📣 Starting broadcast...")
+    monitor = LoopBlockMonitor(); monitor.start(); start = time.perf_counter()
+    broadcast = await bot.Broadcast.create(owner_msg.chat.id, owner_msg.id, status)
+    await broadcast.start()
+    elapsed = time.perf_counter() - start; monitor.stop(); d = broadcast.doc
+    print("\n== broadcast ==")
+    print(f"users: {count}   sent: {d['sent']}   failed: {d['failed']}   elapsed: {elapsed:.2f}s   rate: {count / elapsed:.1f} msg/s")
+    print(f"event loop blocked: {monitor.blocked:.3f}s total, worst stall {monitor.worst * 1000:.1f}ms   floodwaits injected: {tg.floodwaits}")
+
+def import_bot(args, workdir):
+    env = {"API_ID": "1", "API_HASH": "bench", "BOT_TOKEN": "1:bench", "OWNER_ID": "1", "REPORT_CHANNEL_ID": "1",
+           "MONGO_URI": os.environ.get("BENCH_MONGO_URI", "mongodb://127.0.0.1:27017"), "MAX_CONCURRENT_DOWNLOADS": str(args.workers),
+           "MAX_QUEUED_JOBS": str(max(args.jobs, 50)), "BROADCAST_RATE": "1000"}
+    for key, value in env.items(): os.environ.setdefault(key, value)
+    if "BENCH_MONGO_URI" not in os.environ:
+        try: import mongomock
+        except ImportError: sys.exit("mongomock is not installed; pip install mongomock or set BENCH_MONGO_URI to a local mongod.")
+        import pymongo
+        # mongomock trails pymongo: newer pymongo passes options (e.g. `sort`) to bulk UpdateOne ops that
+        # mongomock rejects, which would make every history flush fail while the numbers look healthy.
+        try: mongomock.MongoClient().probe.probe.bulk_write([pymongo.UpdateOne({"_id": 1}, {"$inc": {"n": 1}}, upsert=True)])
+        except Exception as e: sys.exit(f"mongomock {mongomock.__version__} cannot run pymongo {pymongo.version} bulk writes ({e}); "
+                                        "install a pymongo release this mongomock supports, or set BENCH_MONGO_URI to a local mongod.")
+        pymongo.MongoClient = mongomock.MongoClient
+    os.chdir(workdir); os.makedirs("downloads", exist_ok=True); sys.path.insert(0, REPO_DIR)
+    import session_bot
+    return session_bot
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    bot = import_bot(args, workdir)
+    tg = FakeTelegram(args.api_latency, args.upload_mbps, args.floodwait_rate, args.floodwait_seconds, args.floodwait_calls.split(",")); client = FakeClient(tg)
+    bot.app = client; bot.db_call = db_errors = DbErrorCounter(bot.db_call)
+    bot.SITE_REGISTRY.add("127.0.0.1")
+    httpd, base_url = start_media_server(args.media_mb * 1024 * 1024)
+    urls = [f"{base_url}/video-{i}.mp4" for i in range(args.jobs)]
+    users = args.users or args.jobs
+    try:
+        results, elapsed, monitor = await run_links(bot, tg, client, urls, users)
+        report(f"cold links ({args.workers} workers, {args.media_mb}MB each)", results, elapsed, monitor, tg)
+        if args.repeat:
+            results, elapsed, monitor = await run_links(bot, tg, client, urls, users)
+            report("repeat links (file_id cache)", results, elapsed, monitor, tg)
+            print(f"file cache: {bot.file_cache.stats_text()}")
+        if args.broadcast_users: await run_broadcast(bot, tg, args.broadcast_users)
+        await bot.history.flush()
+        print(f"\npeak RSS: {peak_rss_mb():.1f}MB   uploaded: {tg.uploaded_bytes / (1024 * 1024):.1f}MB")
+        written = bot.downloads_collection.count_documents({}); unflushed = len(bot.history.pending)
+        print(f"history docs written: {written}   unflushed: {unflushed}   db errors: {sum(db_errors.errors.values())}")
+        for error, count in db_errors.errors.most_common(): print(f"  {count}x {error}")
+        if db_errors.errors or unflushed: print("WARNING: DB calls failed during the run, so the timings above do not include real DB writes."); return 1
+        return 0
+    finally: httpd.shutdown()
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
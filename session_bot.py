@@ -1,21 +1,34 @@
 import os
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
 import threading
 import traceback
 import io
 import base64
+import copy
+import functools
+import random
+import sys
+import shutil
+import tempfile
+import socket
+from collections import deque, OrderedDict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from itertools import zip_longest
+from urllib.parse import urlsplit
 from yt_dlp import YoutubeDL
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from pyrogram.errors import UserNotParticipant, UserIsBlocked, InputUserDeactivated
+from pyrogram.errors import UserNotParticipant, UserIsBlocked, InputUserDeactivated, FloodWait, FileIdInvalid, FileReferenceExpired, MediaEmpty
 from pyrogram.enums import ChatMemberStatus
 
 from flask import Flask
-from pymongo import MongoClient
-from datetime import datetime, timezone
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
 from PIL import Image
 from bson.objectid import ObjectId
 
@@ -31,6 +44,44 @@ REPORT_CHANNEL_ID = int(os.environ.get("REPORT_CHANNEL_ID"))
 START_PHOTO_URL = "https://telegra.ph/Wow-07-03-5"
 MAINTAINED_BY_URL = "https://t.me/Rexonblood"
 FORCE_SUB_CHANNEL = "@dailynewswalla"
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 3))
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", 2))
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 50))
+MAX_FILESIZE = 450 * 1024 * 1024
+MAX_DURATION = int(os.environ.get("MAX_DURATION", 0))  # seconds, 0 = no limit
+VIDEO_FORMAT = 'bestvideo[ext=mp4][height<=720]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", 600))
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", 200))
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))  # messages/sec, Telegram allows ~30 globally
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 20))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 200))
+BROADCAST_DB_RETRIES = int(os.environ.get("BROADCAST_DB_RETRIES", 6))  # attempts per DB call before a broadcast gives up
+BROADCAST_CHECKPOINT_INTERVAL = float(os.environ.get("BROADCAST_CHECKPOINT_INTERVAL", 2))  # seconds between progress checkpoints
+STAGING_BUDGET_MB = int(os.environ.get("STAGING_BUDGET_MB", 2048))
+STAGING_TMPFS_DIR = os.environ.get("STAGING_TMPFS_DIR", "")  # e.g. /dev/shm, empty = disabled
+STAGING_TMPFS_MAX_MB = int(os.environ.get("STAGING_TMPFS_MAX_MB", 64))
+STAGING_TMPFS_BUDGET_MB = int(os.environ.get("STAGING_TMPFS_BUDGET_MB", 256))
+PROGRESS_EDIT_INTERVAL = float(os.environ.get("PROGRESS_EDIT_INTERVAL", 3))  # seconds between edits in one chat
+PROGRESS_EDIT_RATE = float(os.environ.get("PROGRESS_EDIT_RATE", 15))  # status edits/sec across all chats
+THUMB_THREADS = int(os.environ.get("THUMB_THREADS", 4))
+THUMB_CACHE_SIZE = int(os.environ.get("THUMB_CACHE_SIZE", 200))
+THUMB_CACHE_TTL = int(os.environ.get("THUMB_CACHE_TTL", 6 * 3600))
+THUMB_MAX_SIDE = 320            # Telegram thumbnail limits: 320px on the longest side...
+THUMB_MAX_BYTES = 200 * 1024    # ...and at most 200KB
+THUMB_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+PROFILE_JOB_RATE = float(os.environ.get("PROFILE_JOB_RATE", 0))  # fraction of jobs to sample-profile, 0 = off
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+BOT_MODE = os.environ.get("BOT_MODE", "standalone")  # standalone | frontend | worker
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 60))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+STAGING_STALE_SECONDS = int(os.environ.get("STAGING_STALE_SECONDS", max(600, 10 * JOB_LEASE_SECONDS)))  # a worker root untouched this long belongs to a dead worker
+DB_THREADS = int(os.environ.get("DB_THREADS", 8))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 2))
+HISTORY_MAX_PENDING = int(os.environ.get("HISTORY_MAX_PENDING", 200))
+FILE_CACHE_TTL = int(os.environ.get("FILE_CACHE_TTL", 7 * 24 * 3600))
+FILE_CACHE_LRU_SIZE = int(os.environ.get("FILE_CACHE_LRU_SIZE", 1000))
 
 # --- Default Supported Sites ---
 DEFAULT_SITES = [
@@ -48,14 +99,18 @@ DEFAULT_SITES = [
 ]
 
 # --- State Management & DB Setup ---
-DOWNLOAD_IN_PROGRESS = False
-CANCELLATION_REQUESTS = set()
-SITES_LIST = []
 BROADCAST_IN_PROGRESS = {}
+RUNNING_BROADCASTS = {}
 
 server = Flask(__name__)
 @server.route('/')
 def health_check(): return "Bot and Web Server are alive!", 200
+@server.route('/metrics')
+def metrics_endpoint(): return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+@server.route('/profiles/<job_id>')
+def profile_endpoint(job_id):
+    if (profile := PROFILES.get(job_id)) is None: return "No such profile.", 404
+    return profile, 200, {"Content-Type": "text/plain; charset=utf-8"}
 def run_server(): server.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
 try:
     db_client = MongoClient(MONGO_URI)
@@ -63,37 +118,1037 @@ try:
     users_collection = db.get_collection("users")
     downloads_collection = db.get_collection("downloads_history")
     sites_collection = db.get_collection("supported_sites")
+    file_cache_collection = db.get_collection("file_cache")
+    broadcasts_collection = db.get_collection("broadcasts")
+    stats_collection = db.get_collection("stats")
+    jobs_collection = db.get_collection("jobs")
+    video_limits_collection = db.get_collection("video_limits")
     print("Successfully connected to MongoDB.")
 except Exception as e: print(f"Error connecting to MongoDB: {e}"); exit()
-app = Client("video_downloader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+if BOT_MODE == "worker":
+    # Workers only send and edit messages; updates are received by the front-end's session.
+    app = Client(f"video_downloader_worker_{WORKER_ID}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, in_memory=True, no_updates=True)
+else: app = Client("video_downloader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 # --- Helper Functions (unchanged) ---
 def create_progress_bar(percentage):
     bar_length=10; filled_length=int(bar_length*percentage//100)
     return '🟢'*filled_length+'⚪'*(bar_length-filled_length)
-def get_sites_list_text():
-    reply_text = "✅ **Here are the currently supported sites:**\n\n```\n"
-    sorted_sites = sorted(list(set(SITES_LIST)))
-    if not sorted_sites: return "No sites are currently supported."
-    num_sites = len(sorted_sites); sites_per_column = (num_sites + 2) // 3
-    columns = [sorted_sites[i:i + sites_per_column] for i in range(0, num_sites, sites_per_column)]
-    for row in zip_longest(*columns, fillvalue=""):
-        reply_text += f"{row[0]:<25}{row[1]:<25}{row[2]:<25}\n"
-    reply_text += "```"
-    return reply_text
-def progress_hook(d, m, user_id):
-    if user_id in CANCELLATION_REQUESTS: raise Exception("Download cancelled by user.")
+class SiteRegistry:
+    """Set of supported registrable domains, matched against a URL's hostname label by label.
+
+    "m.youtube.com" matches "youtube.com" by trying each suffix of its labels, while a
+    supported domain that only appears in the path or query string does not match at all.
+    """
+    def __init__(self, domains=()):
+        self.domains = set(); self._text = None
+        self.reset(domains)
+    @staticmethod
+    def normalize(domain):
+        domain = domain.strip().lower()
+        if "://" in domain: domain = urlsplit(domain).hostname or ""
+        return domain.split("/", 1)[0].strip(".")
+    def reset(self, domains): self.domains = {d for d in map(self.normalize, domains) if d}; self._text = None
+    def add(self, domain): self.domains.add(self.normalize(domain)); self._text = None
+    def remove(self, domain): self.domains.discard(self.normalize(domain)); self._text = None
+    def __len__(self): return len(self.domains)
+    def __contains__(self, domain): return self.normalize(domain) in self.domains
+    def match(self, url):
+        """Return the supported domain the URL's host belongs to, or None."""
+        try: host = urlsplit(url).hostname
+        except ValueError: return None
+        if not host: return None
+        labels = host.rstrip(".").split(".")
+        for i in range(len(labels)):
+            if (candidate := ".".join(labels[i:])) in self.domains: return candidate
+        return None
+    def text(self):
+        if self._text is None: self._text = self._render()
+        return self._text
+    def _render(self):
+        reply_text = "✅ **Here are the currently supported sites:**\n\n```\n"
+        sorted_sites = sorted(self.domains)
+        if not sorted_sites: return "No sites are currently supported."
+        num_sites = len(sorted_sites); sites_per_column = (num_sites + 2) // 3
+        columns = [sorted_sites[i:i + sites_per_column] for i in range(0, num_sites, sites_per_column)]
+        for row in zip_longest(*columns, fillvalue=""):
+            reply_text += f"{row[0]:<25}{row[1]:<25}{row[2]:<25}\n"
+        reply_text += "```"
+        return reply_text
+SITE_REGISTRY = SiteRegistry()
+def get_sites_list_text(): return SITE_REGISTRY.text()
+async def delete_later(message, delay):
+    await asyncio.sleep(delay)
+    try: await message.delete()
+    except Exception: pass
+def progress_hook(d, m, user_id, control):
+    # Runs on a download worker thread; progress_reporter takes care of getting the edit onto the event loop.
+    if control.stopped: raise Exception("Download cancelled by user.")
     if d['status']=='downloading' and (total_bytes := d.get('total_bytes') or d.get('total_bytes_estimate')):
         p=(db:=d.get('downloaded_bytes'))/total_bytes*100
-        if(time.time()-globals().get('last_update_time',0))>2:
-            try:asyncio.create_task(m.edit_text(f"⏳ **Downloading...**\n{create_progress_bar(p)} {p:.2f}% [{db/(1024*1024):.1f}MB]", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data=f"cancel_{user_id}")]])));globals()['last_update_time']=time.time()
-            except:pass
-async def upload_progress_callback(c, t, m, user_id):
-    if user_id in CANCELLATION_REQUESTS: raise Exception("Upload cancelled by user.")
+        progress_reporter.update(m, f"⏳ **Downloading...**\n{create_progress_bar(p)} {p:.2f}% [{db/(1024*1024):.1f}MB]", cancel_markup(user_id))
+async def upload_progress_callback(c, t, m, user_id, control):
+    if control.stopped: raise Exception("Upload cancelled by user.")
     p=c/t*100
-    if(time.time()-globals().get('last_upload_update_time',0))>2:
-        try:await m.edit_text(f"⏫ **Uploading...**\n{create_progress_bar(p)} {p:.2f}% [{c/(1024*1024):.1f}MB / {t/(1024*1024):.1f}MB]", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data=f"cancel_{user_id}")]]));globals()['last_upload_update_time']=time.time()
-        except:pass
+    progress_reporter.update(m, f"⏫ **Uploading...**\n{create_progress_bar(p)} {p:.2f}% [{c/(1024*1024):.1f}MB / {t/(1024*1024):.1f}MB]", cancel_markup(user_id))
+
+# --- Metrics & Profiling ---
+class Metrics:
+    """Minimal thread-safe counter/gauge/histogram registry rendered in the Prometheus text format."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    def __init__(self):
+        self._lock = threading.Lock(); self.meta = {}; self.values = {}
+    def describe(self, name, kind, help_text): self.meta[name] = (kind, help_text); self.values.setdefault(name, {})
+    @staticmethod
+    def _labels(labels): return tuple(sorted((k, str(v)) for k, v in labels.items()))
+    def inc(self, name, amount=1, **labels):
+        key = self._labels(labels)
+        with self._lock: series = self.values[name]; series[key] = series.get(key, 0) + amount
+    def set(self, name, value, **labels):
+        with self._lock: self.values[name][self._labels(labels)] = value
+    def observe(self, name, value, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            h = self.values[name].setdefault(key, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound: h["buckets"][i] += 1
+            h["sum"] += value; h["count"] += 1
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe("bot_stage_duration_seconds", time.perf_counter() - start, stage=stage)
+    @staticmethod
+    def _fmt(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs: return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self.meta.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for labels, value in self.values[name].items():
+                    if kind != "histogram": lines.append(f"{name}{self._fmt(labels)} {value}"); continue
+                    for bound, count in zip(self.BUCKETS, value["buckets"]): lines.append(f"{name}_bucket{self._fmt(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{self._fmt(labels, [('le', '+Inf')])} {value['count']}")
+                    lines.append(f"{name}_sum{self._fmt(labels)} {value['sum']}"); lines.append(f"{name}_count{self._fmt(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+METRICS = Metrics()
+METRICS.describe("bot_stage_duration_seconds", "histogram", "Time spent in each job stage.")
+METRICS.describe("bot_downloaded_bytes_total", "counter", "Bytes downloaded from video hosts.")
+METRICS.describe("bot_uploaded_bytes_total", "counter", "Bytes uploaded to Telegram.")
+METRICS.describe("bot_jobs_total", "counter", "Finished download jobs by domain and status.")
+METRICS.describe("bot_cancellations_total", "counter", "Jobs cancelled by users.")
+METRICS.describe("bot_queue_depth", "gauge", "Jobs waiting in the download queue.")
+METRICS.describe("bot_active_jobs", "gauge", "Jobs currently being processed.")
+METRICS.describe("bot_event_loop_lag_seconds", "histogram", "How late the event loop wakes up from a scheduled sleep.")
+
+async def monitor_event_loop_lag(interval=0.5):
+    while True:
+        start = time.monotonic(); await asyncio.sleep(interval)
+        METRICS.observe("bot_event_loop_lag_seconds", max(time.monotonic() - start - interval, 0))
+
+PROFILES = OrderedDict()  # job id -> collapsed stacks, newest last
+class JobProfiler:
+    """Opt-in sampling profiler for one job.
+
+    Samples the stacks of the event-loop thread and of the worker threads the job registers,
+    and renders them as collapsed stacks (flamegraph.pl / speedscope input). The loop thread
+    is shared, so its samples include whatever else the bot was doing at the time.
+    """
+    def __init__(self, job_id, interval=PROFILE_INTERVAL):
+        self.job_id = job_id; self.interval = interval; self.threads = {threading.get_ident(): "loop"}
+        self.samples = Counter(); self._stop = threading.Event(); self._thread = None
+    def add_thread(self, ident, name): self.threads[ident] = name
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True, name=f"profiler-{self.job_id}"); self._thread.start()
+        return self
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, name in list(self.threads.items()):
+                stack, frame = [], frames.get(ident)
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"); frame = frame.f_back
+                if stack: self.samples[";".join([name] + stack[::-1])] += 1
+    def stop(self):
+        self._stop.set(); self._thread.join()
+        PROFILES[self.job_id] = "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+        while len(PROFILES) > 20: PROFILES.popitem(last=False)
+        print(f"Profile for job {self.job_id}: {sum(self.samples.values())} samples, see /profiles/{self.job_id}")
+
+# --- Async Persistence Layer ---
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="mongo")
+async def db_call(fn, *args, **kwargs):
+    """Run a blocking pymongo call on DB_EXECUTOR so it never stalls the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+class HistoryWriter:
+    """Write-behind buffer for `downloads_history` and the counters in `stats`.
+
+    Field updates for the same job are merged in memory and written as one upsert per job,
+    together with the accumulated counter increments, every `interval` seconds.
+    """
+    def __init__(self, history, stats, interval, max_pending):
+        self.history = history; self.stats = stats; self.interval = interval; self.max_pending = max_pending
+        self.pending = {}; self.increments = {}; self._task = None; self._lock = None
+
+    def _ensure_started(self):
+        if self._task is None: self._lock = asyncio.Lock(); self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def record(self, log_id, **fields):
+        self._ensure_started()
+        self.pending.setdefault(log_id, {}).update(fields)
+        if len(self.pending) >= self.max_pending: asyncio.create_task(self.flush())
+
+    def incr(self, doc_id, field, amount=1):
+        self._ensure_started()
+        doc = self.increments.setdefault(doc_id, {}); doc[field] = doc.get(field, 0) + amount
+
+    def finish(self, log_id, status, url, size_bytes=0, **fields):
+        """Record a job's final state and bump the global and per-domain counters."""
+        self.record(log_id, status=status, end_time=datetime.now(timezone.utc), **fields)
+        self.incr("global", "downloads_total"); self.incr("global", f"downloads_{status}")
+        if size_bytes: self.incr("global", "bytes_served", size_bytes)
+        domain = SITE_REGISTRY.match(url) or urlsplit(url).hostname or 'unknown'
+        self.incr(f"domain:{domain}", status); METRICS.inc("bot_jobs_total", domain=domain, status=status)
+
+    async def flush(self):
+        if self._lock is None: return
+        async with self._lock:
+            pending, self.pending = self.pending, {}; increments, self.increments = self.increments, {}
+            try:
+                if pending and self.history is not None:
+                    with METRICS.time("db_write"): await db_call(self.history.bulk_write, [UpdateOne({"_id": k}, {"$set": v}, upsert=True) for k, v in pending.items()], ordered=False)
+                pending = {}
+                if increments and self.stats is not None:
+                    ops = [UpdateOne({"_id": k}, {"$inc": v, **({"$setOnInsert": {"kind": "domain", "domain": k.split(":", 1)[1]}} if k.startswith("domain:") else {})}, upsert=True) for k, v in increments.items()]
+                    with METRICS.time("db_write"): await db_call(self.stats.bulk_write, ops, ordered=False)
+            except Exception as e:
+                print(f"History flush DB Error: {e}")
+                # Put unwritten data back underneath anything recorded since, to retry next flush.
+                for k, v in pending.items(): self.pending[k] = {**v, **self.pending.get(k, {})}
+                for k, v in increments.items():
+                    doc = self.increments.setdefault(k, {})
+                    for field, amount in v.items(): doc[field] = doc.get(field, 0) + amount
+history = HistoryWriter(downloads_collection, stats_collection, HISTORY_FLUSH_INTERVAL, HISTORY_MAX_PENDING)
+
+def ensure_ttl_index(collection, field, ttl):
+    # create_index refuses to change an existing TTL (IndexOptionsConflict), so a new TTL goes through collMod.
+    current = collection.index_information().get(f"{field}_1")
+    if current is None: collection.create_index(field, expireAfterSeconds=ttl)
+    elif current.get("expireAfterSeconds") != ttl: collection.database.command("collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl})
+def ensure_indexes():
+    downloads_collection.create_index("user_id"); downloads_collection.create_index("url")
+    downloads_collection.create_index("status"); downloads_collection.create_index([("start_time", -1)])
+    broadcasts_collection.create_index("status"); stats_collection.create_index("kind")
+    ensure_ttl_index(video_limits_collection, "created_at", METADATA_CACHE_TTL)
+def init_counters():
+    """Seed the `stats` counters from the existing collections the first time they are used."""
+    if stats_collection.find_one({"_id": "global"}) is not None: return
+    success = downloads_collection.count_documents({"status": "success"}); failed = downloads_collection.count_documents({"status": "failed"})
+    size_mb = next(downloads_collection.aggregate([{"$group": {"_id": None, "mb": {"$sum": "$file_size_mb"}}}]), {}).get("mb", 0)
+    stats_collection.update_one({"_id": "global"}, {"$setOnInsert": {"users_total": users_collection.count_documents({}), "downloads_total": success + failed,
+        "downloads_success": success, "downloads_failed": failed, "bytes_served": int(size_mb * 1024 * 1024)}}, upsert=True)
+
+# --- Extraction Metadata Cache ---
+class TTLCache:
+    """Small bounded LRU whose entries expire `ttl` seconds after insertion."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize; self.ttl = ttl; self.data = OrderedDict()
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None: return None
+        if time.monotonic() - item[0] > self.ttl: del self.data[key]; return None
+        self.data.move_to_end(key); return item[1]
+    def put(self, key, value):
+        self.data[key] = (time.monotonic(), value); self.data.move_to_end(key)
+        while len(self.data) > self.maxsize: self.data.popitem(last=False)
+    def pop(self, key): self.data.pop(key, None)
+metadata_cache = TTLCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+# Bulky parts of an info dict that neither process_ie_result (we never write subtitles) nor our own
+# checks use; for YouTube-class extractors they are most of the dict's size.
+METADATA_DROP_KEYS = ("automatic_captions", "subtitles", "requested_subtitles", "heatmap", "thumbnails", "description", "comments")
+def slim_info(info): return {k: v for k, v in info.items() if k not in METADATA_DROP_KEYS}
+
+# In frontend/worker mode extraction happens in the workers, so they share the fields
+# check_video_limits needs through `video_limits` for the front-end's early check.
+async def share_video_limits(url, fmt, info):
+    try: await db_call(video_limits_collection.replace_one, {"_id": f"{fmt}|{url}"}, {"filesize": estimate_filesize(info), "duration": info.get('duration'), "created_at": datetime.now(timezone.utc)}, upsert=True)
+    except Exception as e: print(f"Video limits DB Error: {e}")
+async def shared_video_limits(url, fmt):
+    try: doc = await db_call(video_limits_collection.find_one, {"_id": f"{fmt}|{url}", "created_at": {"$gt": datetime.now(timezone.utc) - timedelta(seconds=METADATA_CACHE_TTL)}})
+    except Exception as e: print(f"Video limits DB Error: {e}"); return None
+    return {"filesize": doc['filesize'], "duration": doc['duration']} if doc else None
+
+def estimate_filesize(info):
+    # Merged downloads list their parts in requested_formats; give up if any part has no size.
+    sizes = [f.get('filesize') or f.get('filesize_approx') for f in (info.get('requested_formats') or [info])]
+    return sum(sizes) if sizes and all(sizes) else None
+def check_video_limits(info, max_filesize=MAX_FILESIZE):
+    """Raise before downloading if the extracted info already shows the video is over our limits."""
+    if (size := estimate_filesize(info)) and max_filesize and size > max_filesize:
+        raise ValueError(f"Video is larger than the {max_filesize // (1024 * 1024)}MB limit ({size / (1024 * 1024):.1f}MB).")
+    if MAX_DURATION and (duration := info.get('duration')) and duration > MAX_DURATION:
+        raise ValueError(f"Video is longer than the {MAX_DURATION}s limit ({int(duration)}s).")
+
+# --- Thumbnail Pipeline ---
+THUMB_EXECUTOR = ThreadPoolExecutor(max_workers=THUMB_THREADS, thread_name_prefix="thumb")
+thumb_session = requests.Session()
+for _scheme in ("http://", "https://"): thumb_session.mount(_scheme, HTTPAdapter(pool_connections=THUMB_THREADS, pool_maxsize=THUMB_THREADS))
+thumbnail_cache = TTLCache(THUMB_CACHE_SIZE, THUMB_CACHE_TTL)
+
+def render_thumbnail(data):
+    """Turn image bytes into a JPEG within Telegram's thumbnail limits, or None if it cannot fit."""
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("RGB", (THUMB_MAX_SIDE, THUMB_MAX_SIDE))  # JPEGs are downscaled by the decoder itself; no-op for other formats
+        img = img.convert("RGB"); img.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+        for quality in (85, 70, 55, 40):
+            out = io.BytesIO(); img.save(out, "JPEG", quality=quality, optimize=True)
+            if out.tell() <= THUMB_MAX_BYTES: return out.getvalue()
+    return None
+
+def fetch_thumbnail_blocking(url):
+    with thumb_session.get(url, timeout=(5, 15), stream=True) as r:
+        r.raise_for_status(); data = bytearray()
+        for chunk in r.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > THUMB_MAX_SOURCE_BYTES: raise ValueError("Thumbnail source image is too large.")
+    return render_thumbnail(bytes(data))
+
+async def get_thumbnail(url):
+    """Fetch and render a thumbnail on THUMB_EXECUTOR, memoized by URL. Returns JPEG bytes or None."""
+    if not url: return None
+    if (data := thumbnail_cache.get(url)) is not None: return data
+    try:
+        with METRICS.time("thumbnail"): data = await asyncio.get_running_loop().run_in_executor(THUMB_EXECUTOR, fetch_thumbnail_blocking, url)
+    except Exception as e: print(f"Thumb Error: {e}"); return None
+    if data: thumbnail_cache.put(url, data)
+    return data
+
+# --- Download Staging ---
+class StagedJob:
+    __slots__ = ("path", "size", "area")
+    def __init__(self, path, size, area): self.path = path; self.size = size; self.area = area
+
+class StagingManager:
+    """Gives every job its own temporary directory and keeps their total size within a budget.
+
+    A job reserves its estimated size before downloading and waits while the reservation would
+    exceed the budget or the free space; it fails at once if it could not fit even on its own.
+    Small files can be staged on an optional tmpfs area with its own budget.
+
+    With `shared=True` each root is this process's own `worker-*` subdirectory of a volume shared
+    with other workers: what the sibling worker directories hold counts against the budget, and
+    `touch` keeps our root's mtime fresh so others can tell it from the leftovers of a dead worker.
+    """
+    PREFIX = "job-"; WORKER_PREFIX = "worker-"
+    def __init__(self, root, budget, tmpfs_root="", tmpfs_max=0, tmpfs_budget=0, shared=False):
+        self.disk = self._area(root, budget, shared)
+        self.tmpfs = self._area(tmpfs_root, tmpfs_budget, shared) if tmpfs_root else None
+        self.tmpfs_max = tmpfs_max; self._cond = None
+
+    @staticmethod
+    def _area(root, budget, shared):
+        return {"root": root, "budget": budget, "reserved": 0, "shared": os.path.dirname(os.path.abspath(root)) if shared else None, "others": (0, 0)}
+
+    def _siblings(self, area):
+        own = os.path.abspath(area["root"])
+        try: return [e.path for e in os.scandir(area["shared"]) if e.name.startswith(self.WORKER_PREFIX) and e.is_dir(follow_symlinks=False) and os.path.abspath(e.path) != own]
+        except OSError: return []
+
+    def _others(self, area):
+        """Bytes other workers have staged next to us, re-scanned at most once a second."""
+        if area["shared"] is None: return 0
+        checked, used = area["others"]
+        if time.monotonic() - checked < 1: return used
+        used = 0
+        for sibling in self._siblings(area):
+            for dirpath, _, files in os.walk(sibling):
+                for name in files:
+                    try: used += os.path.getsize(os.path.join(dirpath, name))
+                    except OSError: pass
+        area["others"] = (time.monotonic(), used); return used
+
+    def _fits(self, area, size):
+        # Reserved space is not on disk yet, so it has to come out of the free space as well.
+        return area["reserved"] + self._others(area) + size <= area["budget"] and size <= shutil.disk_usage(area["root"]).free - area["reserved"]
+
+    def _pick(self, size, size_known):
+        if self.tmpfs and size_known and size <= self.tmpfs_max and self._fits(self.tmpfs, size): return self.tmpfs
+        return self.disk
+
+    async def reserve(self, estimate, on_wait=None, is_cancelled=None):
+        """Reserve space for a job (estimate may be None) and create its directory. Raises ValueError if it can never fit."""
+        if self._cond is None: self._cond = asyncio.Condition()
+        size = min(estimate or MAX_FILESIZE, self.disk["budget"])
+        if estimate and estimate > self.disk["budget"]: raise ValueError(f"Video is larger than the staging budget ({estimate / (1024 * 1024):.1f}MB).")
+        async with self._cond:
+            waited = False
+            while not self._fits(area := self._pick(size, bool(estimate)), size):
+                if is_cancelled and is_cancelled(): raise Exception("Download cancelled by user.")
+                if not area["reserved"] and not self._others(area):  # no other job will release space here, so waiting cannot help
+                    free = shutil.disk_usage(area["root"]).free
+                    if not estimate and free > 0: size = min(size, free); continue  # unknown size: take what is there
+                    raise ValueError(f"Video is larger than the free disk space ({free / (1024 * 1024):.1f}MB free).")
+                if on_wait and not waited: waited = True; on_wait()
+                try: await asyncio.wait_for(self._cond.wait(), timeout=5)  # also re-check free space periodically
+                except asyncio.TimeoutError: pass
+            area["reserved"] += size
+        try: os.makedirs(area["root"], exist_ok=True); return StagedJob(tempfile.mkdtemp(prefix=self.PREFIX, dir=area["root"]), size, area)
+        except Exception: await self._unreserve(area, size); raise
+
+    async def _unreserve(self, area, size):
+        async with self._cond: area["reserved"] -= size; self._cond.notify_all()
+
+    async def release(self, job):
+        await asyncio.to_thread(shutil.rmtree, job.path, True)
+        await self._unreserve(job.area, job.size)
+
+    def touch(self):
+        for area in filter(None, (self.disk, self.tmpfs)):
+            try: os.makedirs(area["root"], exist_ok=True); os.utime(area["root"])
+            except OSError as e: print(f"Staging touch error for {area['root']}: {e}")
+
+    def sweep_orphans(self):
+        """Remove job directories and stray files a previous run left in our own roots.
+
+        Other directories are never touched: on a shared volume they are other workers' roots.
+        """
+        removed = 0
+        for area in filter(None, (self.disk, self.tmpfs)):
+            if not os.path.isdir(area["root"]): continue
+            for entry in os.scandir(area["root"]):
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if (is_dir or area is self.tmpfs) and not entry.name.startswith(self.PREFIX): continue
+                try: shutil.rmtree(entry.path) if is_dir else os.remove(entry.path); removed += 1
+                except OSError as e: print(f"Staging sweep error for {entry.path}: {e}")
+        if removed: print(f"Removed {removed} orphaned staging entries.")
+
+    def sweep_stale(self, stale_after):
+        """Remove the roots of sibling workers that have not touched them for `stale_after` seconds."""
+        removed = 0
+        for area in filter(None, (self.disk, self.tmpfs)):
+            if area["shared"] is None: continue
+            for sibling in self._siblings(area):
+                try:
+                    if time.time() - os.path.getmtime(sibling) < stale_after: continue
+                    shutil.rmtree(sibling); removed += 1
+                except OSError as e: print(f"Staging sweep error for {sibling}: {e}")
+        if removed: print(f"Removed {removed} stale worker staging root(s).")
+# STAGING_TMPFS_DIR is typically shared with other programs (/dev/shm), so we only ever stage and sweep
+# inside our own subdirectory of it. Workers share DOWNLOAD_LOCATION (and that subdirectory) but each
+# stages under its own worker-<WORKER_ID> directory.
+TMPFS_STAGING_ROOT = os.path.join(STAGING_TMPFS_DIR, "video_downloader_staging") if STAGING_TMPFS_DIR else ""
+WORKER_STAGING_DIR = StagingManager.WORKER_PREFIX + WORKER_ID
+staging = StagingManager(os.path.join(DOWNLOAD_LOCATION, WORKER_STAGING_DIR) if BOT_MODE == "worker" else DOWNLOAD_LOCATION, STAGING_BUDGET_MB * 1024 * 1024,
+                         os.path.join(TMPFS_STAGING_ROOT, WORKER_STAGING_DIR) if BOT_MODE == "worker" and TMPFS_STAGING_ROOT else TMPFS_STAGING_ROOT,
+                         STAGING_TMPFS_MAX_MB * 1024 * 1024, STAGING_TMPFS_BUDGET_MB * 1024 * 1024, shared=BOT_MODE == "worker")
+
+# --- Telegram file_id Cache ---
+class FileIdCache:
+    """Maps a canonical video key to the Telegram file_id it was already uploaded as.
+
+    Lookups go through an in-process LRU first and fall back to the `file_cache` collection.
+    Entries expire after `ttl` seconds (Mongo enforces this with a TTL index as well).
+    """
+    def __init__(self, collection, ttl, lru_size):
+        self.collection = collection; self.ttl = ttl; self.lru_size = lru_size
+        self.lru = OrderedDict(); self.hits = 0; self.misses = 0
+
+    @staticmethod
+    def key_for(info, fmt):
+        return f"{info.get('extractor_key') or info.get('extractor', 'generic')}|{info.get('webpage_url') or info.get('original_url')}|{fmt}"
+
+    def ensure_indexes(self):
+        if self.collection is None: return
+        ensure_ttl_index(self.collection, "created_at", self.ttl)
+        self.collection.create_index("webpage_url"); self.collection.create_index([("source_url", 1), ("format", 1)])
+
+    def _expired(self, entry): return datetime.now(timezone.utc) - entry['created_at'] > timedelta(seconds=self.ttl)
+
+    def _remember(self, key, entry):
+        self.lru[key] = entry; self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size: self.lru.popitem(last=False)
+
+    async def get(self, key):
+        entry = self.lru.get(key)
+        if entry is None and self.collection is not None:
+            try: entry = await db_call(self.collection.find_one, {"_id": key})
+            except Exception as e: print(f"File cache DB Error: {e}"); entry = None
+            if entry is not None:
+                if entry['created_at'].tzinfo is None: entry['created_at'] = entry['created_at'].replace(tzinfo=timezone.utc)
+                self._remember(key, entry)
+        if entry is None or self._expired(entry):
+            if entry is not None: await self.invalidate(key)
+            self.misses += 1; return None
+        self.lru.move_to_end(key); self.hits += 1
+        return entry
+
+    async def get_by_source(self, url, fmt):
+        """Cheap first-level lookup by the link exactly as the user sent it, before any extraction.
+
+        A miss here is not counted; the canonical `get` after extraction is the authoritative lookup.
+        """
+        entry = next((e for e in reversed(self.lru.values()) if e['source_url'] == url and e.get('format') == fmt), None)
+        if entry is None and self.collection is not None:
+            try: entry = await db_call(self.collection.find_one, {"source_url": url, "format": fmt}, sort=[("created_at", -1)])
+            except Exception as e: print(f"File cache DB Error: {e}"); entry = None
+            if entry is not None:
+                if entry['created_at'].tzinfo is None: entry['created_at'] = entry['created_at'].replace(tzinfo=timezone.utc)
+                self._remember(entry['_id'], entry)
+        if entry is None or self._expired(entry): return None
+        self.lru.move_to_end(entry['_id']); self.hits += 1
+        return entry
+
+    async def put(self, key, file_id, info, source_url, fmt, file_size=0):
+        entry = {"_id": key, "file_id": file_id, "webpage_url": info.get('webpage_url', source_url), "source_url": source_url, "format": fmt, "title": info.get('title'), "file_size": file_size, "created_at": datetime.now(timezone.utc)}
+        self._remember(key, entry)
+        if self.collection is not None:
+            try: await db_call(self.collection.replace_one, {"_id": key}, entry, upsert=True)
+            except Exception as e: print(f"File cache DB Error: {e}")
+
+    async def invalidate(self, key):
+        self.lru.pop(key, None)
+        if self.collection is not None:
+            try: await db_call(self.collection.delete_one, {"_id": key})
+            except Exception as e: print(f"File cache DB Error: {e}")
+
+    async def invalidate_url(self, url=None):
+        """Drop cached entries for a URL (matched on source or canonical URL), or everything when url is None."""
+        query = {} if url is None else {"$or": [{"webpage_url": url}, {"source_url": url}]}
+        for key in [k for k, e in self.lru.items() if url is None or url in (e['webpage_url'], e['source_url'])]: del self.lru[key]
+        return (await db_call(self.collection.delete_many, query)).deleted_count if self.collection is not None else 0
+
+    def stats_text(self):
+        total = self.hits + self.misses; rate = (self.hits / total * 100) if total else 0
+        return f"File Cache: `{self.hits}` hits / `{self.misses}` misses ({rate:.1f}% hit rate)"
+file_cache = FileIdCache(file_cache_collection, FILE_CACHE_TTL, FILE_CACHE_LRU_SIZE)
+
+# --- Broadcast Engine ---
+class TokenBucket:
+    """Async token bucket; `pause` stops all acquirers until a FloodWait has passed."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate; self.capacity = capacity or rate; self.tokens = self.capacity
+        self.updated = time.monotonic(); self.paused_until = 0
+    def pause(self, seconds): self.paused_until = max(self.paused_until, time.monotonic() + seconds); self.tokens = 0
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until: await asyncio.sleep(self.paused_until - now); continue
+            # No credit accrues while paused, otherwise a full burst would follow every FloodWait.
+            self.updated = max(self.updated, self.paused_until)
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+            if self.tokens >= 1: self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+BROADCAST_BUCKET = TokenBucket(BROADCAST_RATE)
+
+class Broadcast:
+    """Copies one message to every reachable user, checkpointing progress in `broadcasts`.
+
+    Users are streamed in `_id` order one batch at a time. `last_user_id` advances over the
+    finished prefix of the batch and is checkpointed every BROADCAST_CHECKPOINT_INTERVAL seconds,
+    so a restart re-sends at most the messages that were in flight or finished out of order.
+    """
+    def __init__(self, doc):
+        self.doc = doc; self.id = doc['_id']; self.cancelled = False; self.last_edit = 0
+        self.blocked_ids = []; self.acked = 0; self._checkpoint_lock = asyncio.Lock(); self.error = None
+    @classmethod
+    async def create(cls, from_chat_id, message_id, status_message):
+        doc = {"_id": ObjectId(), "from_chat_id": from_chat_id, "message_id": message_id, "status": "running",
+               "status_chat_id": status_message.chat.id, "status_message_id": status_message.id, "last_user_id": None,
+               "total": await db_call(users_collection.count_documents, {"blocked": {"$ne": True}}), "sent": 0, "failed": 0, "blocked": 0,
+               "started_at": datetime.now(timezone.utc)}
+        await db_call(broadcasts_collection.insert_one, doc)
+        return cls(doc)
+
+    def start(self):
+        RUNNING_BROADCASTS[self.id] = self
+        return asyncio.create_task(self.run())
+
+    async def _db(self, fn, *args, **kwargs):
+        """db_call with exponential backoff, so a transient Mongo error does not end the broadcast."""
+        for attempt in range(BROADCAST_DB_RETRIES):
+            try: return await db_call(fn, *args, **kwargs)
+            except Exception as e:
+                if attempt == BROADCAST_DB_RETRIES - 1: raise
+                print(f"Broadcast {self.id} DB error (attempt {attempt + 1}): {e}"); await asyncio.sleep(min(2 ** attempt, 30))
+
+    async def _next_batch(self):
+        query = {"blocked": {"$ne": True}}
+        if self.doc['last_user_id'] is not None: query["_id"] = {"$gt": self.doc['last_user_id']}
+        fetch = lambda: [u['_id'] for u in users_collection.find(query, {"_id": 1}).sort("_id", 1).limit(BROADCAST_BATCH_SIZE)]
+        return await self._db(fetch)
+
+    async def _send(self, user_id, semaphore):
+        async with semaphore:
+            for _ in range(5):
+                await BROADCAST_BUCKET.acquire()
+                try: await app.copy_message(chat_id=user_id, from_chat_id=self.doc['from_chat_id'], message_id=self.doc['message_id']); return "sent"
+                except FloodWait as e: print(f"Broadcast FloodWait: sleeping {e.value}s"); BROADCAST_BUCKET.pause(e.value + 1)
+                except (UserIsBlocked, InputUserDeactivated): return "blocked"
+                except Exception as e: print(f"Broadcast error to user {user_id}: {e}"); return "failed"
+            return "failed"
+
+    def _advance(self, batch, results):
+        """Fold the finished prefix of the batch into the doc; a send finishing early waits for the ones before it."""
+        while self.acked < len(batch) and results[self.acked] is not None:
+            outcome = results[self.acked]; self.doc[outcome] += 1
+            if outcome == "blocked": self.blocked_ids.append(batch[self.acked])
+            self.doc['last_user_id'] = batch[self.acked]; self.acked += 1
+
+    async def _checkpoint(self):
+        async with self._checkpoint_lock:
+            blocked, self.blocked_ids = self.blocked_ids, []
+            progress = {k: self.doc[k] for k in ("sent", "failed", "blocked", "last_user_id")}
+            try:
+                # Flag blocked users first: if we crash in between, they are simply skipped on resume.
+                if blocked: await self._db(users_collection.update_many, {"_id": {"$in": blocked}}, {"$set": {"blocked": True}})
+                await self._db(broadcasts_collection.update_one, {"_id": self.id}, {"$set": progress})
+            except Exception: self.blocked_ids[:0] = blocked; raise
+
+    async def _checkpointer(self):
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            try: await self._checkpoint()
+            except Exception as e: print(f"Broadcast checkpoint error: {e}")  # the end-of-batch checkpoint is the one that must succeed
+            await self._report()
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY); checkpointer = asyncio.create_task(self._checkpointer())
+        try:
+            while not self.cancelled and (batch := await self._next_batch()):
+                results = [None] * len(batch); self.acked = 0
+                async def send(i):
+                    results[i] = await self._send(batch[i], semaphore); self._advance(batch, results)
+                await asyncio.gather(*(send(i) for i in range(len(batch))))
+                await self._checkpoint(); await self._report()
+            self.doc['status'] = "cancelled" if self.cancelled else "done"
+            await self._db(broadcasts_collection.update_one, {"_id": self.id}, {"$set": {"status": self.doc['status'], "end_time": datetime.now(timezone.utc)}})
+            await self._report(final=True)
+        except Exception as e:
+            print(f"--- BROADCAST ERROR ---\n{traceback.format_exc()}\n---")
+            self.doc['status'] = "failed"; self.error = f"{type(e).__name__}: {e}"
+            # If this write fails too the doc stays `running`, and the broadcast resumes from its checkpoint on restart.
+            try: await db_call(broadcasts_collection.update_one, {"_id": self.id}, {"$set": {"status": "failed", "error": self.error, "end_time": datetime.now(timezone.utc)}})
+            except Exception as db_error: print(f"Could not mark broadcast {self.id} failed: {db_error}")
+            await self._report(final=True)
+        finally: checkpointer.cancel(); RUNNING_BROADCASTS.pop(self.id, None)
+
+    def progress_text(self):
+        d = self.doc; done = d['sent'] + d['failed'] + d['blocked']
+        elapsed = max((datetime.now(timezone.utc) - d['started_at'].replace(tzinfo=timezone.utc)).total_seconds(), 1)
+        return (f"Sent: `{d['sent']}`/`{d['total']}`\nFailed: `{d['failed']}`\nBlocked/Deactivated: `{d['blocked']}`\n"
+                f"Rate: `{done / elapsed:.1f}` msg/s")
+
+    async def _report(self, final=False):
+        if not final and time.monotonic() - self.last_edit < 5: return
+        self.last_edit = time.monotonic()
+        title = {"done": "✅ **Broadcast Complete**", "cancelled": "🛑 **Broadcast Cancelled**", "failed": "❌ **Broadcast Failed**"}.get(self.doc['status'], "**Broadcast Progress**")
+        error = f"\nError: `{self.error}`" if self.error else ""
+        try: await app.edit_message_text(self.doc['status_chat_id'], self.doc['status_message_id'], f"{title}\n\n{self.progress_text()}{error}")
+        except Exception: pass
+
+async def resume_broadcasts():
+    for doc in await db_call(lambda: list(broadcasts_collection.find({"status": "running"}))):
+        print(f"Resuming broadcast {doc['_id']} after user {doc['last_user_id']}"); Broadcast(doc).start()
+
+# --- Progress Reporter ---
+class ProgressReporter:
+    """Coalesces status-message edits and flushes them under per-chat and global rate limits.
+
+    `update` may be called from any thread; only the latest text per message is kept, and an
+    edit that would not change the message is skipped. Final edits go through `finalize`, which
+    waits for an edit already in flight and makes every later `update` for that message a no-op.
+    """
+    FINALIZED_KEEP = 4096  # tombstones remembered so late progress updates cannot revive a message
+    SENT_KEEP = 4096       # last texts remembered to skip no-op edits; forgetting one only costs a redundant edit
+    def __init__(self, chat_interval, rate):
+        self.chat_interval = chat_interval; self.bucket = TokenBucket(rate)
+        self.pending = {}; self.sent = OrderedDict(); self.chat_last = {}; self.editing = {}; self.finalized = OrderedDict()
+        self._lock = threading.Lock(); self._loop = None; self._wakeup = None; self._task = None
+
+    @staticmethod
+    def _key(message): return (message.chat.id, message.id)
+
+    def start(self):
+        if self._task is not None: return
+        self._loop = asyncio.get_running_loop(); self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def update(self, message, text, reply_markup=None):
+        if self._task is None:
+            try: self.start()
+            except RuntimeError: pass  # called off-loop before start(); flushed once the reporter starts
+        key = self._key(message)
+        with self._lock:
+            if key in self.finalized: return
+            if self.sent.get(key) == text: self.pending.pop(key, None); return
+            self.pending[key] = (message, text, reply_markup)
+        if self._loop is not None: self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def finalize(self, message, text=None, reply_markup=None):
+        """Make `text` the last edit of `message` (or just retire it when text is None). Returns whether the edit went through."""
+        key = self._key(message)
+        with self._lock:
+            self.pending.pop(key, None); self.sent.pop(key, None); self.finalized[key] = True
+            while len(self.finalized) > self.FINALIZED_KEEP: self.finalized.popitem(last=False)
+            in_flight = self.editing.get(key)
+        if in_flight is not None: await asyncio.shield(in_flight)  # its edit must land before ours
+        if text is None: return True
+        for _ in range(3):
+            await self.bucket.acquire()
+            try: await message.edit_text(text, reply_markup=reply_markup); return True
+            except FloodWait as e: self.bucket.pause(e.value)
+            except Exception as e: print(f"Final edit of {key} failed: {e}"); return False
+        return False
+
+    def _take_ready(self):
+        ready, wait, now = [], None, time.monotonic()
+        with self._lock:
+            for key in list(self.pending):
+                next_time = self.chat_last.get(key[0], 0) + self.chat_interval
+                if now >= next_time: ready.append((key, self.pending.pop(key))); self.chat_last[key[0]] = now
+                else: wait = next_time - now if wait is None else min(wait, next_time - now)
+            # A chat whose interval has passed behaves exactly as if it had never been edited.
+            for chat_id in [c for c, last in self.chat_last.items() if now - last >= self.chat_interval]: del self.chat_last[chat_id]
+        return ready, wait
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            ready, wait = self._take_ready()
+            for key, (message, text, reply_markup) in ready:
+                await self.bucket.acquire()
+                with self._lock:
+                    if key in self.pending or key in self.finalized or self.sent.get(key) == text: continue  # superseded or finalized meanwhile
+                    done = self.editing[key] = self._loop.create_future()
+                try:
+                    await message.edit_text(text, reply_markup=reply_markup)
+                    with self._lock:
+                        if key not in self.finalized:
+                            self.sent[key] = text; self.sent.move_to_end(key)
+                            while len(self.sent) > self.SENT_KEEP: self.sent.popitem(last=False)
+                except FloodWait as e:
+                    self.bucket.pause(e.value)
+                    with self._lock:
+                        if key not in self.finalized: self.pending.setdefault(key, (message, text, reply_markup))
+                except Exception: pass
+                finally: self.editing.pop(key, None); done.set_result(None)
+            if not ready:
+                try: await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError: pass
+progress_reporter = ProgressReporter(PROGRESS_EDIT_INTERVAL, PROGRESS_EDIT_RATE)
+
+# --- Download Job Scheduler ---
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix="ytdlp")
+class JobControl:
+    """Stop flags of one job, read by its download/upload hooks and its wait for staging space.
+
+    `cancelled` is the user's request. `aborted` means this process no longer owns the job (lease
+    lost or shutting down): it has to stop without reporting anything, since the job runs again elsewhere.
+    """
+    __slots__ = ("cancelled", "aborted")
+    def __init__(self): self.cancelled = False; self.aborted = False
+    @property
+    def stopped(self): return self.cancelled or self.aborted
+
+class DownloadJob:
+    __slots__ = ("user_id", "url", "message", "status_message", "shown_position", "control")
+    def __init__(self, user_id, url, message, status_message):
+        self.user_id = user_id; self.url = url; self.message = message; self.status_message = status_message
+        self.shown_position = None; self.control = JobControl()
+
+class DownloadScheduler:
+    """FIFO download queue with round-robin fairness between users.
+
+    Each user has their own FIFO; workers take the next job from the next user in rotation,
+    and a user never has more than one job running at a time.
+    """
+    def __init__(self, workers, per_user_limit, max_queued):
+        self.workers = workers; self.per_user_limit = per_user_limit; self.max_queued = max_queued
+        self.queues = {}          # user_id -> deque of DownloadJob
+        self.rotation = deque()   # user ids with queued jobs, in round-robin order
+        self.active = {}          # user_id -> running DownloadJob
+        self._cond = None; self._tasks = []
+
+    def _ensure_started(self):
+        if self._tasks: return
+        self._cond = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def queued_count(self): return sum(len(q) for q in self.queues.values())
+    def _publish_depth(self): METRICS.set("bot_queue_depth", self.queued_count()); METRICS.set("bot_active_jobs", len(self.active))
+    def idle_workers(self): return max(self.workers - len(self.active), 0)
+    def user_job_count(self, user_id): return len(self.queues.get(user_id, ())) + (user_id in self.active)
+
+    def dispatch_order(self):
+        # Simulate the round-robin to find the order queued jobs will start in.
+        order, pending = [], {uid: list(self.queues[uid]) for uid in self.rotation}
+        while pending:
+            for uid in list(pending):
+                order.append(pending[uid].pop(0))
+                if not pending[uid]: del pending[uid]
+        return order
+
+    def position(self, job):
+        try: return self.dispatch_order().index(job) + 1
+        except ValueError: return 0
+
+    async def submit(self, job):
+        """Queue a job. Returns its 1-based queue position, or raises ValueError with a user-facing reason."""
+        self._ensure_started()
+        if self.user_job_count(job.user_id) >= self.per_user_limit:
+            raise ValueError(f"🤚 You already have {self.per_user_limit} links in progress. Please wait for them to finish.")
+        if self.queued_count() >= self.max_queued:
+            raise ValueError("🤚 **Bot is busy!** The queue is full, please try again in a few minutes.")
+        async with self._cond:
+            if job.user_id not in self.queues: self.queues[job.user_id] = deque(); self.rotation.append(job.user_id)
+            self.queues[job.user_id].append(job); self._publish_depth()
+            self._cond.notify()
+        return self.position(job)
+
+    def _next_job(self):
+        for _ in range(len(self.rotation)):
+            uid = self.rotation.popleft()
+            if uid in self.active: self.rotation.append(uid); continue
+            job = self.queues[uid].popleft()
+            if self.queues[uid]: self.rotation.append(uid)
+            else: del self.queues[uid]
+            return job
+        return None
+
+    async def cancel(self, user_id, status_message_id):
+        """Cancel the job behind one status message: a queued job is dropped, a running one is flagged.
+
+        Returns (removed queued jobs, whether a running job was flagged).
+        """
+        if (job := self.active.get(user_id)) is not None and job.status_message.id == status_message_id:
+            job.control.cancelled = True; return [], True
+        queue = self.queues.get(user_id, ()); removed = [job for job in queue if job.status_message.id == status_message_id]
+        if removed:
+            for job in removed: queue.remove(job)
+            if not queue:
+                del self.queues[user_id]
+                try: self.rotation.remove(user_id)
+                except ValueError: pass
+            METRICS.inc("bot_cancellations_total", len(removed)); self._publish_depth()
+            self._refresh_positions()
+        return removed, False
+
+    def _refresh_positions(self):
+        for pos, job in enumerate(self.dispatch_order(), start=1):
+            if job.shown_position == pos: continue
+            job.shown_position = pos
+            progress_reporter.update(job.status_message, queued_text(pos), cancel_markup(job.user_id))
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                while (job := self._next_job()) is None: await self._cond.wait()
+                self.active[job.user_id] = job; self._publish_depth()
+            self._refresh_positions()
+            try: await run_download_job(job)
+            except Exception: print(f"--- UNHANDLED ERROR IN DOWNLOAD WORKER ---\n{traceback.format_exc()}\n---")
+            finally:
+                async with self._cond: self.active.pop(job.user_id, None); self._publish_depth(); self._cond.notify_all()
+
+def cancel_markup(user_id): return InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data=f"cancel_{user_id}")]])
+def queued_text(position): return f"🕒 **Queued.** Your position in the queue: `{position}`"
+scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_JOBS_PER_USER, MAX_QUEUED_JOBS)
+
+async def run_download_job(job):
+    try:
+        progress_reporter.update(job.status_message, "✅ **URL received. Starting process...**", cancel_markup(job.user_id))
+        return await process_video_url(job.url, {}, job.message, job.status_message, control=job.control)
+    except Exception as e:
+        print(f"--- UNHANDLED ERROR IN LINK_HANDLER ---\n{traceback.format_exc()}\n---")
+        if not job.control.aborted: await progress_reporter.finalize(job.status_message, f"❌ A critical error occurred: {e}")
+        return False
+
+# --- Distributed Job Queue (BOT_MODE=frontend / worker) ---
+class RemoteMessage:
+    """Stands in for a pyrogram Message that a worker process only knows by chat and message id."""
+    def __init__(self, chat_id, message_id, user_id=None):
+        self.chat = SimpleNamespace(id=chat_id); self.id = message_id; self.from_user = SimpleNamespace(id=user_id)
+    async def edit_text(self, text, reply_markup=None): return await app.edit_message_text(self.chat.id, self.id, text, reply_markup=reply_markup)
+    async def delete(self): return await app.delete_messages(self.chat.id, self.id)
+
+class MongoJobQueue:
+    """Download queue shared by one front-end and any number of worker processes via `jobs`.
+
+    Workers claim the oldest queued job atomically and hold it under a lease they renew while it
+    runs. If a worker dies, its lease expires and the job is queued again, up to `max_attempts`.
+    Cancellation is a `cancel_requested` flag that the owning worker picks up on its next heartbeat;
+    a flagged job is never queued or claimed again, even if its lease runs out before it stops.
+
+    The front-end edits a status message only while the job is queued and held with `edit_hold_until`,
+    which workers respect when claiming; from the claim on, the worker is the message's only writer.
+    """
+    EDIT_HOLD = 30; EDIT_TIMEOUT = 10  # seconds a position edit may keep workers off a job / may take
+    def __init__(self, collection, lease_seconds, max_attempts):
+        self.collection = collection; self.lease = lease_seconds; self.max_attempts = max_attempts
+        self._position_edits = {}  # front-end: job id -> future of the position edit in flight
+
+    def ensure_indexes(self):
+        self.collection.create_index([("status", 1), ("created_at", 1)])
+        self.collection.create_index([("user_id", 1), ("status", 1)])
+        self.collection.create_index([("status_chat_id", 1), ("status_message_id", 1)])
+        self.collection.create_index([("status", 1), ("lease_expires", 1)])
+
+    # Front-end side
+    async def enqueue(self, user_id, url, message, status_message):
+        """Queue a job. Returns (job id, 1-based queue position), or raises ValueError with a user-facing reason."""
+        if await db_call(self.collection.count_documents, {"user_id": user_id, "status": {"$in": ["queued", "running"]}}) >= MAX_JOBS_PER_USER:
+            raise ValueError(f"🤚 You already have {MAX_JOBS_PER_USER} links in progress. Please wait for them to finish.")
+        if await db_call(self.collection.count_documents, {"status": "queued"}) >= MAX_QUEUED_JOBS:
+            raise ValueError("🤚 **Bot is busy!** The queue is full, please try again in a few minutes.")
+        now = datetime.now(timezone.utc)
+        result = await db_call(self.collection.insert_one, {"user_id": user_id, "url": url, "status": "queued", "attempts": 0, "cancel_requested": False,
+            "chat_id": message.chat.id, "message_id": message.id, "status_chat_id": status_message.chat.id,
+            "status_message_id": status_message.id, "created_at": now})
+        return result.inserted_id, await db_call(self.collection.count_documents, {"status": "queued", "created_at": {"$lte": now}})
+
+    async def show_position(self, job_id, user_id, status_message, position):
+        """Edit a queued job's status message to its queue position, unless it has started or already shows it."""
+        # Registered before the hold is taken, so a cancel racing with us always finds it.
+        done = self._position_edits[job_id] = asyncio.get_running_loop().create_future(); held = False
+        try:
+            held = await db_call(self.collection.find_one_and_update, {"_id": job_id, "status": "queued", "shown_position": {"$ne": position}},
+                {"$set": {"shown_position": position, "edit_hold_until": datetime.now(timezone.utc) + timedelta(seconds=self.EDIT_HOLD)}}) is not None
+            if held: await asyncio.wait_for(status_message.edit_text(queued_text(position), reply_markup=cancel_markup(user_id)), self.EDIT_TIMEOUT)
+        except Exception as e: print(f"Queue position edit for job {job_id} failed: {e}")
+        finally:
+            if self._position_edits.get(job_id) is done: del self._position_edits[job_id]
+            done.set_result(None)
+            if held: await db_call(self.collection.update_one, {"_id": job_id}, {"$unset": {"edit_hold_until": ""}})
+
+    async def refresh_positions(self):
+        """Re-show queue positions as jobs ahead are claimed or cancelled (front-end side)."""
+        queued = await db_call(lambda: list(self.collection.find({"status": "queued"}, {"user_id": 1, "status_chat_id": 1, "status_message_id": 1, "shown_position": 1}).sort("created_at", 1)))
+        for position, doc in enumerate(queued, start=1):
+            if doc.get('shown_position') != position:
+                await self.show_position(doc['_id'], doc['user_id'], RemoteMessage(doc['status_chat_id'], doc['status_message_id'], doc['user_id']), position)
+
+    async def request_cancel(self, user_id, status_chat_id, status_message_id):
+        """Cancel the job behind one status message: dropped if still queued, flagged if running.
+
+        Returns (cancelled queued docs, running count).
+        """
+        job = {"user_id": user_id, "status_chat_id": status_chat_id, "status_message_id": status_message_id}
+        queued = await db_call(self.collection.find_one_and_update, {**job, "status": "queued"}, {"$set": {"status": "cancelled"}})
+        if queued:
+            if (in_flight := self._position_edits.get(queued['_id'])) is not None: await asyncio.shield(in_flight)  # let it land before the caller's final edit
+            return [queued], 0
+        running = await db_call(self.collection.update_many, {**job, "status": "running"}, {"$set": {"cancel_requested": True}})
+        return [], running.matched_count
+
+    # Worker side
+    async def claim(self, worker_id):
+        now = datetime.now(timezone.utc)
+        return await db_call(self.collection.find_one_and_update, {"status": "queued", "cancel_requested": False, "$or": [{"edit_hold_until": None}, {"edit_hold_until": {"$lt": now}}]},
+            {"$set": {"status": "running", "lease_owner": worker_id, "lease_expires": now + timedelta(seconds=self.lease), "started_at": now}, "$inc": {"attempts": 1}},
+            sort=[("created_at", 1)], return_document=ReturnDocument.AFTER)
+
+    async def heartbeat(self, job_id, worker_id):
+        """Extend our lease. Returns the current job doc, or None if the lease was lost."""
+        return await db_call(self.collection.find_one_and_update, {"_id": job_id, "lease_owner": worker_id, "status": "running"},
+            {"$set": {"lease_expires": datetime.now(timezone.utc) + timedelta(seconds=self.lease)}}, return_document=ReturnDocument.AFTER)
+
+    async def counts(self):
+        """(queued, running) job counts across all workers."""
+        return await db_call(self.collection.count_documents, {"status": "queued"}), await db_call(self.collection.count_documents, {"status": "running"})
+
+    async def complete(self, job_id, worker_id, status):
+        await db_call(self.collection.update_one, {"_id": job_id, "lease_owner": worker_id}, {"$set": {"status": status, "end_time": datetime.now(timezone.utc)}, "$unset": {"lease_owner": "", "lease_expires": ""}})
+
+    async def _end_expired(self, query, status, text):
+        # One atomic update per job, with the expiry in the filter: a heartbeat landing meanwhile keeps
+        # the job alive, and only the reaper that wins the update edits the status message.
+        ended = 0
+        while (doc := await db_call(self.collection.find_one_and_update, {**query, "status": "running", "lease_expires": {"$lt": datetime.now(timezone.utc)}},
+                {"$set": {"status": status, "end_time": datetime.now(timezone.utc)}, "$unset": {"lease_owner": "", "lease_expires": ""}})) is not None:
+            ended += 1
+            try: await app.edit_message_text(doc['status_chat_id'], doc['status_message_id'], text)
+            except Exception: pass
+        return ended
+
+    async def requeue_expired(self):
+        """Put jobs whose worker stopped heartbeating back in the queue; give up after max_attempts.
+
+        Jobs the user asked to cancel are closed as cancelled instead of being queued again.
+        """
+        await self._end_expired({"cancel_requested": True}, "cancelled", "✅ **Operation cancelled.**")
+        await self._end_expired({"attempts": {"$gte": self.max_attempts}}, "failed", "❌ **This link failed repeatedly and was dropped.**")
+        expired = {"status": "running", "lease_expires": {"$lt": datetime.now(timezone.utc)}, "attempts": {"$lt": self.max_attempts}, "cancel_requested": False}
+        requeued = await db_call(self.collection.update_many, expired, {"$set": {"status": "queued"}, "$unset": {"lease_owner": "", "lease_expires": ""}})
+        if requeued.modified_count: print(f"Re-queued {requeued.modified_count} job(s) with expired leases.")
+
+    async def release(self, worker_id):
+        """Hand our running jobs back to the queue on a clean shutdown (cancelled ones are closed instead)."""
+        unset = {"lease_owner": "", "lease_expires": ""}
+        await db_call(self.collection.update_many, {"status": "running", "lease_owner": worker_id, "cancel_requested": True}, {"$set": {"status": "cancelled", "end_time": datetime.now(timezone.utc)}, "$unset": unset})
+        await db_call(self.collection.update_many, {"status": "running", "lease_owner": worker_id}, {"$set": {"status": "queued"}, "$unset": unset, "$inc": {"attempts": -1}})
+job_queue = MongoJobQueue(jobs_collection, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
+
+class JobQueueWorker:
+    """Runs `concurrency` claim loops in a worker process plus a reaper for expired leases."""
+    def __init__(self, queue, worker_id, concurrency):
+        self.queue = queue; self.worker_id = worker_id; self.concurrency = concurrency; self.active = 0
+
+    async def run(self):
+        await asyncio.gather(self._reaper(), *(self._slot() for _ in range(self.concurrency)))
+
+    async def _reaper(self):
+        while True:
+            try: await self.queue.requeue_expired()
+            except Exception as e: print(f"Job reaper error: {e}")
+            await asyncio.to_thread(staging.touch); await asyncio.to_thread(staging.sweep_stale, STAGING_STALE_SECONDS)
+            await asyncio.sleep(self.queue.lease / 2)
+
+    async def _slot(self):
+        while True:
+            try: doc = await self.queue.claim(self.worker_id)
+            except Exception as e: print(f"Job claim error: {e}"); doc = None
+            if doc is None: await asyncio.sleep(JOB_POLL_INTERVAL); continue
+            await self._run(doc)
+
+    async def _run(self, doc):
+        user_id = doc['user_id']
+        job = DownloadJob(user_id, doc['url'], RemoteMessage(doc['chat_id'], doc['message_id'], user_id), RemoteMessage(doc['status_chat_id'], doc['status_message_id'], user_id))
+        print(f"[{self.worker_id}] Claimed job {doc['_id']} (attempt {doc['attempts']})")
+        self.active += 1; METRICS.set("bot_active_jobs", self.active)
+        heartbeat = asyncio.create_task(self._heartbeat(doc, job.control)); delivered = False
+        try: delivered = await run_download_job(job)
+        except asyncio.CancelledError: job.control.aborted = True; raise  # shutting down: release() hands the job back to the queue
+        finally:
+            heartbeat.cancel(); self.active -= 1; METRICS.set("bot_active_jobs", self.active)
+            status = "done" if delivered else "cancelled" if job.control.cancelled else "failed"
+            if not job.control.aborted: await self.queue.complete(doc['_id'], self.worker_id, status)
+
+    async def _heartbeat(self, doc, control):
+        while True:
+            await asyncio.sleep(self.queue.lease / 3)
+            try: current = await self.queue.heartbeat(doc['_id'], self.worker_id)
+            except Exception as e: print(f"Heartbeat error for job {doc['_id']}: {e}"); continue
+            if current is None: control.aborted = True; return  # re-queued elsewhere; stop so the job isn't delivered twice
+            if current.get('cancel_requested'): control.cancelled = True  # keep the lease until the job has actually stopped
+
+async def watch_job_queue(queue, interval=5):
+    """Front-end side: the queue lives in Mongo, so the depth gauges and queue positions are refreshed from there."""
+    while True:
+        try: queued, running = await queue.counts(); METRICS.set("bot_queue_depth", queued); METRICS.set("bot_active_jobs", running)
+        except Exception as e: print(f"Queue metrics error: {e}")
+        try: await queue.refresh_positions()
+        except Exception as e: print(f"Queue position refresh error: {e}")
+        await asyncio.sleep(interval)
 
 # --- Bot Commands (Now separate and will work correctly) ---
 @app.on_message(filters.command("start") & filters.private)
@@ -109,8 +1164,10 @@ async def start_command(client, message):
     except Exception as e: print(f"Error during force sub check: {e}"); await message.reply_text("An error occurred while checking your membership status."); return
     u = message.from_user
     if users_collection is not None:
-        ud={"_id":u.id,"first_name":u.first_name,"last_name":u.last_name,"username":u.username,"last_started":datetime.now(timezone.utc)}
-        try:users_collection.update_one({"_id":u.id},{"$set":ud},upsert=True);print(f"User {u.id} saved.")
+        ud={"_id":u.id,"first_name":u.first_name,"last_name":u.last_name,"username":u.username,"last_started":datetime.now(timezone.utc),"blocked":False}
+        try:
+            result=await db_call(users_collection.update_one,{"_id":u.id},{"$set":ud},upsert=True);print(f"User {u.id} saved.")
+            if result.upserted_id is not None: history.incr("global","users_total")
         except Exception as e:print(f"DB Error: {e}")
     start_text = ("» **I'M RX Downloader BOT**\n\n" + "📥 **I CAN DOWNLOAD VIDEOS FROM:**\n" + "• YOUTUBE, INSTAGRAM, TIKTOK\n" + "• PORNHUB, XVIDEOS, XNXX\n" + "• AND 1000+ OTHER SITES!\n\n" + "🚀 **JUST SEND ME A LINK!**")
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("• SUPPORTED SITES", callback_data="show_sites_list"), InlineKeyboardButton("• MAINTAINED BY", url=MAINTAINED_BY_URL)]])
@@ -128,16 +1185,33 @@ async def help_command(client, message):
 # --- Admin Commands (Now separate and will work correctly) ---
 @app.on_message(filters.command("stats") & filters.user(OWNER_ID))
 async def stats_command(client, message):
-    total_users = users_collection.count_documents({})
-    await message.reply_text(f"📊 **Bot Stats**\n\nTotal Users: `{total_users}`")
+    await history.flush()
+    counters = await db_call(stats_collection.find_one, {"_id": "global"}) or {}
+    top_domains = await db_call(lambda: list(stats_collection.find({"kind": "domain"}).sort("success", -1).limit(5)))
+    success, failed = counters.get("downloads_success", 0), counters.get("downloads_failed", 0)
+    rate = (success / (success + failed) * 100) if success + failed else 0
+    domains = "".join(f"\n• `{d['domain']}`: {d.get('success', 0)} ✅ / {d.get('failed', 0)} ❌" for d in top_domains) or "\n• none yet"
+    broadcasts = "".join(f"\n\n📣 **Broadcast `{b.id}`**\n{b.progress_text()}" for b in RUNNING_BROADCASTS.values())
+    await message.reply_text(f"📊 **Bot Stats**\n\nTotal Users: `{counters.get('users_total', 0)}`\n"
+                             f"Downloads: `{success + failed}` ({rate:.1f}% success)\n"
+                             f"Bytes Served: `{counters.get('bytes_served', 0) / (1024 ** 3):.2f} GB`\n"
+                             f"{file_cache.stats_text()}\n\n**Top Domains:**{domains}{broadcasts}")
+
+@app.on_message(filters.command("clearcache") & filters.user(OWNER_ID))
+async def clear_cache_command(client, message):
+    try:
+        parts = message.text.split(" ", 1); url = parts[1].strip() if len(parts) > 1 else None
+        removed = await file_cache.invalidate_url(url or None)
+        await message.reply_text(f"✅ Removed `{removed}` cached file(s)" + (f" for `{url}`." if url else "."))
+    except Exception as e: await message.reply_text(f"An error occurred: {e}")
 
 @app.on_message(filters.command("addsite") & filters.user(OWNER_ID))
 async def add_site_command(client, message):
     try:
-        domain = message.text.split(" ", 1)[1].strip().lower()
+        domain = SiteRegistry.normalize(message.text.split(" ", 1)[1])
         if not domain: await message.reply_text("Usage: `/addsite example.com`"); return
-        if sites_collection.find_one({"domain": domain}): await message.reply_text(f"`{domain}` is already in the list."); return
-        sites_collection.insert_one({"domain": domain}); SITES_LIST.append(domain)
+        if await db_call(sites_collection.find_one, {"domain": domain}): SITE_REGISTRY.add(domain); await message.reply_text(f"`{domain}` is already in the list."); return
+        await db_call(sites_collection.insert_one, {"domain": domain}); SITE_REGISTRY.add(domain)
         await message.reply_text(f"✅ Successfully added `{domain}`.")
     except IndexError: await message.reply_text("Usage: `/addsite example.com`")
     except Exception as e: await message.reply_text(f"An error occurred: {e}")
@@ -145,11 +1219,11 @@ async def add_site_command(client, message):
 @app.on_message(filters.command("delsite") & filters.user(OWNER_ID))
 async def del_site_command(client, message):
     try:
-        domain = message.text.split(" ", 1)[1].strip().lower()
+        domain = SiteRegistry.normalize(message.text.split(" ", 1)[1])
         if not domain: await message.reply_text("Usage: `/delsite example.com`"); return
-        result = sites_collection.delete_one({"domain": domain})
+        result = await db_call(sites_collection.delete_many, {"domain": domain})
         if result.deleted_count > 0:
-            if domain in SITES_LIST: SITES_LIST.remove(domain)
+            SITE_REGISTRY.remove(domain)
             await message.reply_text(f"✅ Successfully removed `{domain}`.")
         else: await message.reply_text(f"`{domain}` was not found.")
     except IndexError: await message.reply_text("Usage: `/delsite example.com`")
@@ -167,6 +1241,9 @@ async def cancel_broadcast_command(client, message):
     if message.from_user.id in BROADCAST_IN_PROGRESS:
         del BROADCAST_IN_PROGRESS[message.from_user.id]
         await message.reply_text("Broadcast mode cancelled.")
+    elif RUNNING_BROADCASTS:
+        for b in RUNNING_BROADCASTS.values(): b.cancelled = True
+        await message.reply_text("Stopping the running broadcast after the current batch.")
     else: await message.reply_text("You are not in broadcast mode.")
 
 # --- Callback Handlers (unchanged) ---
@@ -188,7 +1265,17 @@ async def report_link_handler(client, callback_query):
 async def cancel_handler(client, callback_query):
     user_id = int(callback_query.data.split("_")[1])
     if callback_query.from_user.id != user_id: await callback_query.answer("This is not for you!", show_alert=True); return
-    CANCELLATION_REQUESTS.add(user_id); await callback_query.answer("Cancellation request sent.", show_alert=False); await callback_query.message.edit_text("🤚 **Cancellation requested...** Please wait.")
+    # The button sits on the job's status message, so that message identifies which job to cancel.
+    if BOT_MODE == "frontend":
+        queued, running = await job_queue.request_cancel(user_id, callback_query.message.chat.id, callback_query.message.id)
+        removed = [RemoteMessage(d['status_chat_id'], d['status_message_id'], user_id) for d in queued]
+    else:
+        jobs, running = await scheduler.cancel(user_id, callback_query.message.id); removed = [job.status_message for job in jobs]
+    for status_message in removed: await progress_reporter.finalize(status_message, "✅ **Operation cancelled.**")
+    if running:
+        await callback_query.answer("Cancellation request sent.", show_alert=False)
+        progress_reporter.update(callback_query.message, "🤚 **Cancellation requested...** Please wait.")
+    else: await callback_query.answer("Cancelled.", show_alert=False)
 
 # --- NEW: Main Handler for non-command messages ---
 @app.on_message(filters.private & ~filters.command())
@@ -198,110 +1285,188 @@ async def main_message_handler(client, message):
     # Check if the owner is sending a broadcast message
     if user_id in BROADCAST_IN_PROGRESS:
         del BROADCAST_IN_PROGRESS[user_id]
-        all_users_cursor = users_collection.find({}, {'_id': 1})
-        all_user_ids = [user['_id'] for user in all_users_cursor]
-        total_users, success_count, failed_count = len(all_user_ids), 0, 0
-        
-        status_msg = await message.reply_text(f"Broadcasting to {total_users} users...")
-        for i, user_id in enumerate(all_user_ids):
-            try:
-                await message.copy(chat_id=user_id) # Use .copy() to forward any message type
-                success_count += 1
-            except (UserIsBlocked, InputUserDeactivated): failed_count += 1
-            except Exception as e: failed_count += 1; print(f"Broadcast error to user {user_id}: {e}")
-            if (i + 1) % 20 == 0 or (i + 1) == total_users:
-                await status_msg.edit_text(f"**Broadcast Progress**\n\nSent: {success_count}/{total_users}\nFailed: {failed_count}"); await asyncio.sleep(1)
-        await status_msg.edit_text(f"✅ **Broadcast Complete**\nSent to: {success_count}\nFailed for: {failed_count}"); return
+        status_msg = await message.reply_text("📣 Starting broadcast...")
+        (await Broadcast.create(message.chat.id, message.id, status_msg)).start(); return
 
     # If not a broadcast, assume it's a link and process it
     await link_processor(client, message)
 
+def video_caption(title, source): return f"**Title:** {title}\n**Source:** {source}"
+
+async def send_cached_video(user_id, url, cached, reply_to=None):
+    """Re-send an already uploaded file_id.
+
+    Returns None only when Telegram rejects the file_id itself; that entry is dropped and the caller
+    downloads again. FloodWaits are waited out; any other error (blocked user, network) is raised.
+    """
+    caption = video_caption(cached.get('title') or 'Untitled Video', cached.get('webpage_url') or url)
+    for attempt in range(3):
+        try:
+            with METRICS.time("upload"): return await app.send_video(chat_id=user_id, video=cached['file_id'], caption=caption, supports_streaming=True, reply_to_message_id=reply_to)
+        except FloodWait as e:
+            if attempt == 2: raise
+            print(f"[{user_id}] FloodWait re-sending a cached file_id: sleeping {e.value}s"); await asyncio.sleep(e.value)
+        except (FileIdInvalid, FileReferenceExpired, MediaEmpty, ValueError) as e:  # ValueError: the file_id no longer decodes
+            print(f"[{user_id}] Cached file_id rejected, re-downloading: {e}"); await file_cache.invalidate(cached['_id']); return None
+
 async def link_processor(client, message):
     # This function now contains all the link processing logic
     user_id = message.from_user.id
     try:
-        member = await client.get_chat_member(chat_id=FORCE_SUB_CHANNEL, user_id=user_id)
+        with METRICS.time("membership_check"): member = await client.get_chat_member(chat_id=FORCE_SUB_CHANNEL, user_id=user_id)
         if member.status in [ChatMemberStatus.BANNED, ChatMemberStatus.RESTRICTED]: await message.reply_text("You are banned from using this bot."); return
     except UserNotParticipant:
         join_button = InlineKeyboardMarkup([[InlineKeyboardButton("Join Our Channel", url=f"https://t.me/{FORCE_SUB_CHANNEL.lstrip('@')}")]])
         await message.reply_text("To use this bot, you must join our channel. After joining, send the link again.", reply_markup=join_button); return
     except Exception as e: print(f"Error during force sub check: {e}"); await message.reply_text("An error occurred checking membership."); return
-    global DOWNLOAD_IN_PROGRESS
-    if DOWNLOAD_IN_PROGRESS: await message.reply_text("🤚 **Bot is busy!** Please try again in a few minutes."); return
-    
     url = message.text.strip() if message.text else ""
     if not url.startswith(('http://', 'https://')):
         await message.reply_text("Please send a valid link or use /help."); return
 
-    if not any(site in url for site in SITES_LIST):
+    if SITE_REGISTRY.match(url) is None:
         await message.reply_text("❌ **Sorry, this website is not supported.**\n\nUse /sites to see the full list."); return
+    # Links sent before are answered straight from the file_id cache, without queueing or extracting.
+    if cached := await file_cache.get_by_source(url, VIDEO_FORMAT):
+        log_id = ObjectId()
+        try: sent = await send_cached_video(user_id, url, cached, reply_to=message.id)
+        except Exception as e:
+            history.record(log_id, user_id=user_id, url=url, video_title=cached.get('title'), start_time=datetime.now(timezone.utc))
+            history.finish(log_id, "failed", url, error_message=str(e), cached=True)
+            print(f"[{user_id}] Could not re-send cached video: {e}"); await message.reply_text(f"❌ An error occurred: {type(e).__name__}"); return
+        if sent:
+            history.record(log_id, user_id=user_id, url=url, video_title=cached.get('title'), status="processing", start_time=datetime.now(timezone.utc))
+            history.finish(log_id, "success", url, cached.get('file_size', 0), cached=True); return
+    info = metadata_cache.get((url, VIDEO_FORMAT))
+    if info is None and BOT_MODE == "frontend" and (info := await shared_video_limits(url, VIDEO_FORMAT)) is not None: metadata_cache.put((url, VIDEO_FORMAT), info)
+    if info is not None:
+        try: check_video_limits(info)
+        except ValueError as e: await message.reply_text(f"❌ **Error:** {e}"); return
         
-    DOWNLOAD_IN_PROGRESS = True; CANCELLATION_REQUESTS.discard(user_id)
-    status_message = await message.reply_text("✅ **URL received. Starting process...**", quote=True, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data=f"cancel_{user_id}")]]))
-    try:
-        await process_video_url(url, {}, message, status_message)
-    except Exception as e: print(f"--- UNHANDLED ERROR IN LINK_HANDLER ---\n{traceback.format_exc()}\n---"); await status_message.edit_text(f"❌ A critical error occurred: {e}")
-    finally: CANCELLATION_REQUESTS.discard(user_id); DOWNLOAD_IN_PROGRESS = False
+    status_message = await message.reply_text("🕒 **Queued...**", quote=True, reply_markup=cancel_markup(user_id))
+    if BOT_MODE == "frontend":
+        try: job_id, position = await job_queue.enqueue(user_id, url, message, status_message)
+        except ValueError as e: await progress_reporter.finalize(status_message, str(e)); return
+        await job_queue.show_position(job_id, user_id, status_message, position); return  # not via progress_reporter: the worker owns the message once it claims the job
+    job = DownloadJob(user_id, url, message, status_message)
+    try: position = await scheduler.submit(job)
+    except ValueError as e: await progress_reporter.finalize(status_message, str(e)); return
+    if position > scheduler.idle_workers():
+        job.shown_position = position
+        progress_reporter.update(status_message, queued_text(position), cancel_markup(user_id))
+
+async def announce_delivery(status_message, sent_message, is_album_item):
+    """Final touches once the video reached the user; the job is already recorded as a success, so errors are only logged."""
+    await progress_reporter.finalize(status_message, None if is_album_item else "✅ **Upload complete!**")
+    if sent_message and DUMP_CHANNEL_ID != 0:
+        try: await sent_message.forward(DUMP_CHANNEL_ID)
+        except Exception as e: print(f"Could not forward to the dump channel: {e}")
 
-async def process_video_url(url, ydl_opts_override, original_message, status_message, is_album_item=False):
-    # This function remains our core download logic
-    video_path, thumbnail_path = None, None; user_id = original_message.from_user.id
+async def process_video_url(url, ydl_opts_override, original_message, status_message, is_album_item=False, control=None):
+    # This function remains our core download logic. Returns True once delivered, False on failure, None if aborted.
+    video_path, thumbnail_path, stage, thumb_task = None, None, None, None; user_id = original_message.from_user.id; control = control or JobControl()
     download_log_id = ObjectId()
-    if downloads_collection is not None: downloads_collection.insert_one({"_id": download_log_id, "user_id": user_id, "url": url, "status": "processing", "start_time": datetime.now(timezone.utc)})
-    ydl_opts = {'format':'bestvideo[ext=mp4][height<=720]+bestaudio[ext=m4a]/best[ext=mp4]/best','outtmpl':os.path.join(DOWNLOAD_LOCATION,'%(title)s.%(ext)s'),'noplaylist':True,'quiet':True,'progress_hooks':[lambda d:progress_hook(d,status_message,original_message.from_user.id)],'max_filesize':450*1024*1024,}
+    profiler = JobProfiler(str(download_log_id)).start() if PROFILE_JOB_RATE and random.random() < PROFILE_JOB_RATE else None
+    history.record(download_log_id, user_id=user_id, url=url, status="processing", start_time=datetime.now(timezone.utc))
+    loop = asyncio.get_running_loop()
+    ydl_opts = {'format':VIDEO_FORMAT,'noplaylist':True,'quiet':True,'progress_hooks':[lambda d:progress_hook(d,status_message,original_message.from_user.id,control)],'max_filesize':MAX_FILESIZE,}
     ydl_opts.update(ydl_opts_override)
+    # yt-dlp is fully synchronous, so extraction and download run on DOWNLOAD_EXECUTOR threads.
+    def extract_blocking():
+        if profiler: profiler.add_thread(threading.get_ident(), "extract")
+        with YoutubeDL(ydl_opts) as ydl: return ydl.extract_info(url, download=False)
+    def download_blocking(info, stage_dir):
+        # Feed the already-extracted info back in instead of ydl.download([url]), which would run the extractor again.
+        if profiler: profiler.add_thread(threading.get_ident(), "download")
+        final_paths = []
+        with YoutubeDL({**ydl_opts, 'outtmpl': os.path.join(stage_dir, '%(title)s.%(ext)s'), 'post_hooks': [final_paths.append]}) as ydl:
+            result = ydl.process_ie_result(copy.deepcopy(info), download=True) or {}
+        # post_hooks receive the path after merging/post-processing; requested_downloads is the fallback.
+        path = final_paths[-1] if final_paths else next((d['filepath'] for d in result.get('requested_downloads') or [] if d.get('filepath')), None)
+        if not path or not os.path.exists(path): raise FileNotFoundError("Download produced no output file.")
+        # Concurrent jobs must never pick up each other's files: only accept output inside this job's directory.
+        if os.path.commonpath([os.path.realpath(path), os.path.realpath(stage_dir)]) != os.path.realpath(stage_dir): raise FileNotFoundError("Download output escaped the job directory.")
+        return path
     try:
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False); video_title = info.get('title', 'Untitled Video')
-            if downloads_collection is not None: downloads_collection.update_one({"_id": download_log_id}, {"$set": {"video_title": video_title}})
-            print(f"[{user_id}] Starting download for: {video_title}"); ydl.download([url])
-            list_of_files = [os.path.join(DOWNLOAD_LOCATION, f) for f in os.listdir(DOWNLOAD_LOCATION)]
-            if not list_of_files: raise FileNotFoundError("Download folder is empty.")
-            video_path = max(list_of_files, key=os.path.getctime)
-            file_size_mb = round(os.path.getsize(video_path) / (1024 * 1024), 2)
-        if thumbnail_url := info.get('thumbnail'):
-            try:
-                r=requests.get(thumbnail_url); r.raise_for_status()
-                with Image.open(io.BytesIO(r.content)) as img: thumbnail_path = os.path.join(DOWNLOAD_LOCATION, "thumb.jpg"); img.convert("RGB").save(thumbnail_path, "jpeg")
-            except Exception as e: print(f"Thumb Error: {e}"); thumbnail_path = None
-        await status_message.edit_text("⬆️ **Uploading to Telegram...**", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data=f"cancel_{user_id}")]]))
-        sent_message = await app.send_video(chat_id=user_id, video=video_path, caption=f"**Title:** {video_title}\n**Source:** {info.get('webpage_url', url)}", thumb=thumbnail_path, supports_streaming=True, progress=upload_progress_callback, progress_args=(status_message, user_id))
-        if downloads_collection is not None: downloads_collection.update_one({"_id": download_log_id}, {"$set": {"status": "success", "end_time": datetime.now(timezone.utc), "file_size_mb": file_size_mb}})
-        if not is_album_item: await status_message.edit_text("✅ **Upload complete!**", reply_markup=None)
-        if sent_message and DUMP_CHANNEL_ID != 0: await sent_message.forward(DUMP_CHANNEL_ID)
+        metadata_key = (url, ydl_opts['format'])
+        if (info := metadata_cache.get(metadata_key)) is None:
+            with METRICS.time("extract_info"): info = slim_info(await loop.run_in_executor(DOWNLOAD_EXECUTOR, extract_blocking))
+            metadata_cache.put(metadata_key, info)
+            if BOT_MODE == "worker": await share_video_limits(url, ydl_opts['format'], info)
+        video_title = info.get('title', 'Untitled Video')
+        check_video_limits(info, ydl_opts.get('max_filesize'))
+        history.record(download_log_id, video_title=video_title)
+        caption = video_caption(video_title, info.get('webpage_url', url))
+        cache_key = FileIdCache.key_for(info, ydl_opts['format'])
+        if cached := await file_cache.get(cache_key):
+            if await send_cached_video(user_id, url, cached):
+                history.finish(download_log_id, "success", url, cached.get('file_size', 0), cached=True)
+                await announce_delivery(status_message, None, is_album_item); return True
+        stage = await staging.reserve(estimate_filesize(info), on_wait=lambda: progress_reporter.update(status_message, "💾 **Waiting for free disk space...**", cancel_markup(user_id)), is_cancelled=lambda: control.stopped)
+        thumb_task = asyncio.create_task(get_thumbnail(info.get('thumbnail')))  # runs alongside the download
+        print(f"[{user_id}] Starting download for: {video_title}")
+        try:
+            with METRICS.time("download"): video_path = await loop.run_in_executor(DOWNLOAD_EXECUTOR, download_blocking, info, stage.path)
+        except Exception: metadata_cache.pop(metadata_key); raise  # media URLs in the info may have gone stale
+        file_size = os.path.getsize(video_path); file_size_mb = round(file_size / (1024 * 1024), 2); METRICS.inc("bot_downloaded_bytes_total", file_size)
+        if thumb_data := await thumb_task:
+            thumbnail_path = os.path.join(stage.path, "thumb.jpg")
+            with open(thumbnail_path, "wb") as f: f.write(thumb_data)
+        progress_reporter.update(status_message, "⬆️ **Uploading to Telegram...**", cancel_markup(user_id))
+        with METRICS.time("upload"): sent_message = await app.send_video(chat_id=user_id, video=video_path, caption=caption, thumb=thumbnail_path, supports_streaming=True, progress=upload_progress_callback, progress_args=(status_message, user_id, control))
+        METRICS.inc("bot_uploaded_bytes_total", file_size)
+        if sent_message and (media := sent_message.video or sent_message.document): await file_cache.put(cache_key, media.file_id, info, url, ydl_opts['format'], file_size)
+        history.finish(download_log_id, "success", url, file_size, file_size_mb=file_size_mb)
+        await announce_delivery(status_message, sent_message, is_album_item); return True
+    except asyncio.CancelledError: control.aborted = True; raise
     except Exception as e:
+        if control.aborted:  # another worker owns the job now; it reports the outcome, not us
+            print(f"[{user_id}] Job aborted: {e}"); history.record(download_log_id, status="aborted", end_time=datetime.now(timezone.utc)); return
         error_message = f"❌ An error occurred: {type(e).__name__}"; report_markup = None
-        if "cancelled by user" in str(e): error_message = "✅ **Operation cancelled."
+        if control.cancelled: error_message = "✅ **Operation cancelled."; METRICS.inc("bot_cancellations_total")
         else:
             if "is larger than" in str(e): error_message = "❌ **Error:** Video is too large."
+            elif "is longer than" in str(e): error_message = "❌ **Error:** Video is too long."
             encoded_url = base64.urlsafe_b64encode(url.encode()).decode()
             report_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🚨 Report Link", callback_data=f"report_{encoded_url}")]])
-        if downloads_collection is not None: downloads_collection.update_one({"_id": download_log_id}, {"$set": {"status": "failed", "error_message": str(e)}})
+        history.finish(download_log_id, "failed", url, error_message=str(e))
         print(f"--- PROCESS_VIDEO_URL ERROR ---\n{traceback.format_exc()}\n--------------------")
-        if not is_album_item: await status_message.edit_text(error_message, reply_markup=report_markup)
+        await progress_reporter.finalize(status_message, None if is_album_item else error_message, report_markup); return False
     finally:
-        if video_path and os.path.exists(video_path): os.remove(video_path)
-        if thumbnail_path and os.path.exists(thumbnail_path): os.remove(thumbnail_path)
-        if not is_album_item:
-            await asyncio.sleep(5)
-            try: await status_message.delete()
-            except Exception: pass
+        if thumb_task and not thumb_task.done(): thumb_task.cancel()
+        if profiler: profiler.stop()
+        if stage: await staging.release(stage)
+        if not is_album_item and not control.aborted: asyncio.create_task(delete_later(status_message, 5))  # don't hold the worker slot while waiting
 
 # --- Main Entry Point ---
 def load_sites_from_db():
-    global SITES_LIST
     sites = sites_collection.find()
     db_sites = [s['domain'] for s in sites]
     if not db_sites:
         print("No sites in DB. Populating with defaults...")
         sites_to_insert = [{"domain": s} for s in DEFAULT_SITES]
         sites_collection.insert_many(sites_to_insert)
-        SITES_LIST = DEFAULT_SITES
-    else: SITES_LIST = db_sites
-    print(f"Loaded {len(SITES_LIST)} supported sites.")
+        SITE_REGISTRY.reset(DEFAULT_SITES)
+    else: SITE_REGISTRY.reset(db_sites)
+    print(f"Loaded {len(SITE_REGISTRY)} supported sites.")
 if __name__ == "__main__":
     if not os.path.exists(DOWNLOAD_LOCATION): os.makedirs(DOWNLOAD_LOCATION)
+    if BOT_MODE != "frontend": staging.touch(); staging.sweep_orphans()  # the front-end never downloads, so it has nothing to sweep
     load_sites_from_db()
+    for step in (ensure_indexes, file_cache.ensure_indexes, job_queue.ensure_indexes, init_counters):
+        try: step()  # independent steps: one failing must not skip the others
+        except Exception as e: print(f"Error in {step.__qualname__}: {e}")
     print("Starting web server thread...")
     threading.Thread(target=run_server, daemon=True).start()
-    print("
\ No newline at end of file
+    print(f"Starting bot in {BOT_MODE} mode...")
+    async def worker_main():
+        await app.start(); progress_reporter.start(); asyncio.create_task(monitor_event_loop_lag())
+        worker = asyncio.create_task(JobQueueWorker(job_queue, WORKER_ID, MAX_CONCURRENT_DOWNLOADS).run())
+        await idle(); worker.cancel()
+        await job_queue.release(WORKER_ID); await history.flush(); await app.stop()
+    async def main():
+        await app.start(); progress_reporter.start(); asyncio.create_task(monitor_event_loop_lag())
+        if BOT_MODE == "frontend": asyncio.create_task(watch_job_queue(job_queue))
+        try: await resume_broadcasts()
+        except Exception as e: print(f"Error resuming broadcasts: {e}")
+        await idle(); await history.flush(); await app.stop()
+    app.run(worker_main() if BOT_MODE == "worker" else main())
@@ -0,0 +1,109 @@
+"""Lease state machine of MongoJobQueue (claim, cancel, expiry, reclaim) against mongomock."""
+import os
+import sys
+import asyncio
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("pyrogram")
+
+@pytest.fixture(scope="module")
+def bot():
+    for key, value in {"API_ID": "1", "API_HASH": "test", "BOT_TOKEN": "1:test", "OWNER_ID": "1", "REPORT_CHANNEL_ID": "1", "MONGO_URI": "mongodb://127.0.0.1:27017"}.items():
+        os.environ.setdefault(key, value)
+    import pymongo; pymongo.MongoClient = mongomock.MongoClient
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import session_bot
+    return session_bot
+
+class FakeApp:
+    def __init__(self): self.edits = []
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None): self.edits.append((message_id, text))
+
+@pytest.fixture
+def queue(bot, monkeypatch):
+    monkeypatch.setattr(bot, "app", FakeApp())
+    return bot.MongoJobQueue(mongomock.MongoClient().db.jobs, lease_seconds=60, max_attempts=3)
+
+def message(message_id, chat_id=100): return SimpleNamespace(id=message_id, chat=SimpleNamespace(id=chat_id))
+
+def expire(queue, job_id):
+    queue.collection.update_one({"_id": job_id}, {"$set": {"lease_expires": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+
+async def enqueue_and_claim(queue, user_id=1, status_id=11, worker="w1"):
+    await queue.enqueue(user_id, "https://example.com/v", message(10), message(status_id))
+    return await queue.claim(worker)
+
+def test_expired_job_is_reclaimed_by_another_worker(bot, queue):
+    async def scenario():
+        doc = await enqueue_and_claim(queue)
+        expire(queue, doc['_id']); await queue.requeue_expired()
+        again = await queue.claim("w2")
+        assert again['_id'] == doc['_id'] and again['attempts'] == 2
+        await queue.complete(doc['_id'], "w1", "done")  # the old owner no longer holds the lease
+        assert queue.collection.find_one({"_id": doc['_id']})['status'] == "running"
+        await queue.complete(doc['_id'], "w2", "done")
+        assert queue.collection.find_one({"_id": doc['_id']})['status'] == "done"
+    asyncio.run(scenario())
+
+def test_cancelled_job_is_not_revived_after_lease_expiry(bot, queue):
+    async def scenario():
+        doc = await enqueue_and_claim(queue)
+        assert await queue.request_cancel(1, 100, 11) == ([], 1)
+        expire(queue, doc['_id']); await queue.requeue_expired()
+        assert queue.collection.find_one({"_id": doc['_id']})['status'] == "cancelled"
+        assert await queue.claim("w2") is None
+        assert bot.app.edits == [(11, "✅ **Operation cancelled.**")]
+    asyncio.run(scenario())
+
+def test_cancel_of_queued_job_drops_it(bot, queue):
+    async def scenario():
+        await queue.enqueue(1, "https://example.com/v", message(10), message(11))
+        queued, running = await queue.request_cancel(1, 100, 11)
+        assert len(queued) == 1 and running == 0
+        assert await queue.claim("w1") is None
+    asyncio.run(scenario())
+
+def test_job_over_max_attempts_fails_once(bot, queue):
+    async def scenario():
+        doc = await enqueue_and_claim(queue)
+        queue.collection.update_one({"_id": doc['_id']}, {"$set": {"attempts": 3}})
+        assert await queue.heartbeat(doc['_id'], "w1") is not None  # a live lease is left alone
+        await queue.requeue_expired()
+        assert queue.collection.find_one({"_id": doc['_id']})['status'] == "running"
+        expire(queue, doc['_id'])
+        await asyncio.gather(queue.requeue_expired(), queue.requeue_expired())
+        assert queue.collection.find_one({"_id": doc['_id']})['status'] == "failed"
+        assert len(bot.app.edits) == 1
+    asyncio.run(scenario())
+
+def test_release_requeues_running_jobs_but_closes_cancelled_ones(bot, queue):
+    async def scenario():
+        kept = await enqueue_and_claim(queue, user_id=1, status_id=11)
+        cancelled = await enqueue_and_claim(queue, user_id=2, status_id=12)
+        await queue.request_cancel(2, 100, 12)
+        await queue.release("w1")
+        assert queue.collection.find_one({"_id": kept['_id']})['status'] == "queued"
+        assert queue.collection.find_one({"_id": cancelled['_id']})['status'] == "cancelled"
+        assert (await queue.claim("w2"))['_id'] == kept['_id']
+    asyncio.run(scenario())
+
+def test_position_edit_keeps_workers_off_the_job(bot, queue):
+    class StatusMessage:
+        def __init__(self): self.id = 11; self.chat = SimpleNamespace(id=100); self.texts = []; self.claimed_during_edit = "not run"
+        async def edit_text(self, text, reply_markup=None):
+            self.texts.append(text); self.claimed_during_edit = await queue.claim("w1")
+    async def scenario():
+        status = StatusMessage()
+        job_id, position = await queue.enqueue(1, "https://example.com/v", message(10), status)
+        await queue.show_position(job_id, 1, status, position)
+        assert status.texts == [bot.queued_text(1)] and status.claimed_during_edit is None
+        await queue.show_position(job_id, 1, status, position)  # already shown: no second edit
+        assert len(status.texts) == 1
+        assert (await queue.claim("w1"))['_id'] == job_id  # the hold is gone once the edit landed
+        await queue.show_position(job_id, 1, status, 2)  # started: the worker owns the message now
+        assert len(status.texts) == 1
+    asyncio.run(scenario())